@@ -0,0 +1,177 @@
+import msgpack
+import numpy as np
+import os
+import struct
+import zlib
+
+MAGIC = b'BAARCH01'
+_FOOTER = struct.Struct('<Q8s')
+
+
+def packb(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data):
+    '''Unpacks msgpack data with str keys on old and new msgpack versions.'''
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+def pack_array(array, dtype=None):
+    '''Converts an array into a msgpack-able dict.
+
+    Args:
+        array (ndarray): The array
+        dtype (str, optional): Convert to this dtype before packing
+
+    Returns:
+        The dict with dtype, shape and the raw data
+    '''
+    array = np.ascontiguousarray(array, dtype=dtype)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape),
+            'data': array.tobytes()}
+
+
+def unpack_array(packed):
+    '''Reverses pack_array.'''
+    return np.frombuffer(packed['data'], dtype=packed['dtype']).reshape(
+        packed['shape'])
+
+
+class ArchiveWriter(object):
+    '''Writes records into a single chunked archive file. Records are
+    msgpack-able objects stored under a str key. They are grouped into
+    zlib compressed chunks and an index for random access is appended when
+    the archive is closed.'''
+
+    def __init__(self, path, chunksize=64, level=1):
+        '''Constructs a new ArchiveWriter
+
+        Args:
+            path (str): The path of the archive file
+            chunksize (int, optional): The count of records per chunk
+            level (int, optional): The zlib compression level
+        '''
+        self.path = path
+        self.chunksize = chunksize
+        self.level = level
+        # Per process, concurrent builders of the same archive must not
+        # write into one file
+        self._tmp = '{}.{}.part'.format(path, os.getpid())
+        self.file = open(self._tmp, 'wb')
+        self.index = {}
+        self.chunks = []
+        self.meta = {}
+        self._pending = []
+
+    def put(self, key, record):
+        '''Adds a record. Writing a key again shadows the older record.'''
+        self._pending.append((key, record))
+        if len(self._pending) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        '''Writes the pending records as one chunk.'''
+        if len(self._pending) == 0:
+            return
+        chunk = len(self.chunks)
+        for pos, (key, _) in enumerate(self._pending):
+            self.index[key] = (chunk, pos)
+        data = zlib.compress(packb([r for _, r in self._pending]),
+                             self.level)
+        self.chunks.append((self.file.tell(), len(data)))
+        self.file.write(data)
+        self._pending = []
+
+    def close(self):
+        '''Writes the index and moves the archive in place.'''
+        self.flush()
+        offset = self.file.tell()
+        self.file.write(packb({'index': self.index, 'chunks': self.chunks,
+                               'meta': self.meta}))
+        self.file.write(_FOOTER.pack(offset, MAGIC))
+        self.file.close()
+        os.replace(self._tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Archive(object):
+    '''Random access reader for files written by ArchiveWriter.'''
+
+    def __init__(self, path):
+        '''Opens the archive at path.
+
+        Args:
+            path (str): The path of the archive file
+        '''
+        self.path = path
+        with open(path, 'rb') as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            end = f.tell()
+            offset, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError('{} is no archive'.format(path))
+            f.seek(offset)
+            header = unpackb(f.read(end - offset))
+        self.index = {k: tuple(v) for k, v in header['index'].items()}
+        self.chunks = [tuple(c) for c in header['chunks']]
+        self.meta = header['meta']
+        self._file = None
+        self._cached = (None, None)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        '''Returns the keys in storage order.'''
+        return sorted(self.index, key=lambda k: self.index[k])
+
+    def chunk(self, chunk):
+        '''Returns all records of one chunk.'''
+        if self._cached[0] != chunk:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+            offset, length = self.chunks[chunk]
+            self._file.seek(offset)
+            data = zlib.decompress(self._file.read(length))
+            self._cached = (chunk, unpackb(data))
+        return self._cached[1]
+
+    def __getitem__(self, key):
+        chunk, pos = self.index[key]
+        return self.chunk(chunk)[pos]
+
+    def get(self, key, default=None):
+        if key not in self.index:
+            return default
+        return self[key]
+
+    def items(self):
+        '''Iterates over all (key, record) pairs chunk by chunk.'''
+        for key in self.keys():
+            yield key, self[key]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,255 @@
+import numpy as np
+
+
+def mirror_coordinates(idx, n):
+    '''Maps integer coordinates outside [0, n) back into the range as if the
+    axis was reflect padded (mirrored at the border pixels, np.pad's
+    'reflect').
+
+    Args:
+        idx (ndarray): The integer coordinates
+        n (int): The length of the axis
+
+    Returns:
+        The mirrored coordinates
+    '''
+    period = max(2 * (n - 1), 1)
+    idx = np.abs(idx) % period
+    return np.where(idx >= n, period - idx, idx)
+
+
+def _sampling_grid(start, stop, length, n):
+    '''Computes the bilinear sampling coordinates of one axis for a batch of
+    crops.
+
+    Returns:
+        The lower and upper mirrored neighbours (k, length) and the weight of
+        the upper neighbour (k, length, 1, 1)
+    '''
+    scale = (stop - start) / length
+    coords = (start[:, None] - 0.5 +
+              (np.arange(length)[None, :] + 0.5) * scale[:, None])
+    lo = np.floor(coords)
+    weight = (coords - lo).astype(np.float32)
+    lo = lo.astype(np.intp)
+    return (mirror_coordinates(lo, n), mirror_coordinates(lo + 1, n),
+            weight)
+
+
+def crop_and_resize(im, boxes, shape, out=None):
+    '''Crops all boxes out of an image and resizes them to a common shape
+    with bilinear interpolation in one vectorized pass. Boxes may reach over
+    the border of the image, the missing pixels are mirrored.
+
+    Args:
+        im (ndarray): The image (h, w, c)
+        boxes (ndarray): The boxes (k, 4) as [y0, x0, y1, x1] with exclusive
+            ends, in pixels
+        shape (tuple): The output shape (h, w) of a single crop
+        out (ndarray, optional): Write the crops into this array
+
+    Returns:
+        The crops (k, c, h, w) as float32
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    y_lo, y_hi, wy = _sampling_grid(boxes[:, 0], boxes[:, 2], shape[0],
+                                    im.shape[0])
+    x_lo, x_hi, wx = _sampling_grid(boxes[:, 1], boxes[:, 3], shape[1],
+                                    im.shape[1])
+    wy = wy[:, :, None, None]
+    wx = wx[:, None, :, None]
+    # Gather from the flattened image, much faster than 2d fancy indexing
+    flat = np.asarray(im, dtype=np.float32).reshape(-1, im.shape[2])
+    y_lo = y_lo[:, :, None] * im.shape[1]
+    y_hi = y_hi[:, :, None] * im.shape[1]
+    x_lo, x_hi = x_lo[:, None, :], x_hi[:, None, :]
+    top = np.take(flat, y_lo + x_lo, axis=0)
+    top += (np.take(flat, y_lo + x_hi, axis=0) - top) * wx
+    bottom = np.take(flat, y_hi + x_lo, axis=0)
+    bottom += (np.take(flat, y_hi + x_hi, axis=0) - bottom) * wx
+    top += (bottom - top) * wy
+    crops = top.transpose((0, 3, 1, 2))
+    if out is None:
+        return np.ascontiguousarray(crops)
+    out[...] = crops
+    return out
+
+
+def rgb_to_hsv(batch):
+    '''Converts a batch of RGB images (n, 3, h, w) in [0, 1] to HSV, using
+    the same conventions as skimage.color.rgb2hsv.
+
+    Returns:
+        The hue, saturation and value arrays (n, h, w)
+    '''
+    r, g, b = batch[:, 0], batch[:, 1], batch[:, 2]
+    v = batch.max(axis=1)
+    delta = v - batch.min(axis=1)
+    grey = delta == 0
+    delta[grey] = 1
+    s = np.where(v == 0, 0, delta / np.where(v == 0, 1, v))
+    s[grey] = 0
+    h = (g - b) / delta
+    h = np.where(g == v, 2 + (b - r) / delta, h)
+    h = np.where(b == v, 4 + (r - g) / delta, h)
+    h = (h / 6) % 1
+    h[grey] = 0
+    return h, s, v
+
+
+def hsv_to_rgb(h, s, v, out):
+    '''Converts hue, saturation and value arrays (n, h, w) back to a batch of
+    RGB images, using the same conventions as skimage.color.hsv2rgb.
+
+    Args:
+        h, s, v (ndarray): The hue, saturation and value arrays
+        out (ndarray): The batch (n, 3, h, w) to write into
+    '''
+    hi = np.floor(h * 6)
+    f = h * 6 - hi
+    hi = hi.astype(np.int8) % 6
+    p = v * (1 - s)
+    q = v * (1 - f * s)
+    t = v * (1 - (1 - f) * s)
+    # For every sextant of hi the source of r, g and b
+    table = ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v),
+             (v, p, q))
+    for c in range(3):
+        out[:, c] = np.choose(hi, [row[c] for row in table])
+
+
+def hsv_jitter(batch, rng=np.random, power=(0.25, 4), factor=(0.7, 1.4),
+               shift=(-0.1, 0.1)):
+    '''Jitters saturation and value of a whole batch in place. Every sample
+    gets its own parameters, the channel c in (s, v) becomes
+    c ** power * factor + shift.
+
+    Args:
+        batch (ndarray): The float batch (n, 3, h, w) in RGB and [0, 1]
+        rng (np.random.RandomState, optional): The random generator
+        power (tuple, optional): The range of the exponent
+        factor (tuple, optional): The range of the factor
+        shift (tuple, optional): The range of the shift
+
+    Returns:
+        The batch
+    '''
+    n = len(batch)
+    h, s, v = rgb_to_hsv(batch)
+    for channel in (s, v):
+        params = [rng.uniform(low, high, (n, 1, 1)).astype(batch.dtype)
+                  for low, high in (power, factor, shift)]
+        np.power(channel, params[0], out=channel)
+        channel *= params[1]
+        channel += params[2]
+    hsv_to_rgb(h, s, v, batch)
+    return batch
+
+
+def random_affine(n, shape, rng=np.random, rotation=15, shear=0.2,
+                  zoom=0.2, shift=0.05, flip=True):
+    '''Draws one affine transformation per sample. Rotation, shear, zoom,
+    shift and the horizontal flip are composed into a single matrix, which
+    maps output pixel coordinates (row, col, 1) to input coordinates around
+    the center of the image.
+
+    Args:
+        n (int): The count of samples
+        shape (tuple): The shape (h, w) of the images
+        rng (np.random.RandomState, optional): The random generator
+        rotation (float, optional): The range of the rotation in degrees
+        shear (float, optional): The range of the shear angle in radians
+        zoom (float, optional): The zoom is drawn from [1 - zoom, 1 + zoom]
+            independently for both axes
+        shift (float, optional): The range of the shift relative to the size
+        flip (bool, optional): Whether to flip half of the samples
+
+    Returns:
+        The matrices (n, 3, 3)
+    '''
+    theta = np.deg2rad(rng.uniform(-rotation, rotation, n))
+    shear = rng.uniform(-shear, shear, n)
+    zoom = rng.uniform(1 - zoom, 1 + zoom, (2, n))
+    shifts = rng.uniform(-shift, shift, (2, n)) * np.reshape(shape, (2, 1))
+    mats = np.zeros((n, 3, 3))
+    mats[:, 2, 2] = 1
+    # rotation . shift . shear . zoom
+    mats[:, 0, 0] = np.cos(theta) * zoom[0]
+    mats[:, 0, 1] = (-np.cos(theta) * np.sin(shear) -
+                     np.sin(theta) * np.cos(shear)) * zoom[1]
+    mats[:, 1, 0] = np.sin(theta) * zoom[0]
+    mats[:, 1, 1] = (-np.sin(theta) * np.sin(shear) +
+                     np.cos(theta) * np.cos(shear)) * zoom[1]
+    mats[:, 0, 2] = np.cos(theta) * shifts[0] - np.sin(theta) * shifts[1]
+    mats[:, 1, 2] = np.sin(theta) * shifts[0] + np.cos(theta) * shifts[1]
+    # Transform around the center
+    center = (np.array(shape, dtype=np.float64) - 1) / 2
+    mats[:, :2, 2] += center - np.einsum('nij,j->ni', mats[:, :2, :2],
+                                         center)
+    if flip:
+        flipped = rng.random_sample(n) < 0.5
+        mats[flipped, :, 2] += mats[flipped, :, 1] * (shape[1] - 1)
+        mats[flipped, :, 1] *= -1
+    return mats
+
+
+def warp_affine(batch, mats, out=None):
+    '''Warps a whole batch with one affine matrix per sample, using bilinear
+    interpolation. Pixels outside the input take the value of the nearest
+    border pixel.
+
+    Args:
+        batch (ndarray): The batch (n, c, h, w)
+        mats (ndarray): The matrices (n, 3, 3) from output to input
+            coordinates, see random_affine
+        out (ndarray, optional): Write the result into this array, must not
+            be batch itself
+
+    Returns:
+        The warped batch as float32
+    '''
+    n, c, h, w = batch.shape
+    grid = np.mgrid[:h, :w].reshape(2, -1).astype(np.float64)
+    coords = np.einsum('nij,jp->nip', mats[:, :2, :2], grid)
+    coords += mats[:, :2, 2, None]
+    rows = np.clip(coords[:, 0], 0, h - 1)
+    cols = np.clip(coords[:, 1], 0, w - 1)
+    r_lo = np.minimum(np.floor(rows), h - 2).astype(np.intp)
+    c_lo = np.minimum(np.floor(cols), w - 2).astype(np.intp)
+    wr = (rows - r_lo).astype(np.float32)[..., None]
+    wc = (cols - c_lo).astype(np.float32)[..., None]
+    # Flat indices into (n, h * w, c) with the sample offsets
+    flat = np.ascontiguousarray(batch, dtype=np.float32).reshape(n, c, -1)
+    flat = flat.transpose((0, 2, 1)).reshape(-1, c)
+    base = r_lo * w + c_lo + (np.arange(n) * h * w)[:, None]
+    top = np.take(flat, base, axis=0)
+    top += (np.take(flat, base + 1, axis=0) - top) * wc
+    bottom = np.take(flat, base + w, axis=0)
+    bottom += (np.take(flat, base + w + 1, axis=0) - bottom) * wc
+    top += (bottom - top) * wr
+    warped = top.transpose((0, 2, 1)).reshape(n, c, h, w)
+    if out is None:
+        return np.ascontiguousarray(warped)
+    out[...] = warped
+    return out
+
+
+class Augmenter(object):
+    '''Random geometric augmentation of whole batches, a replacement for
+    keras' ImageDataGenerator with fill mode 'nearest'.'''
+
+    def __init__(self, rotation=15, shear=0.2, zoom=0.2, shift=0.05,
+                 flip=True):
+        '''Constructs a new Augmenter, see random_affine for the ranges.'''
+        self.params = dict(rotation=rotation, shear=shear, zoom=zoom,
+                           shift=shift, flip=flip)
+
+    def __call__(self, batch, rng=np.random, out=None):
+        '''Warps every sample of a batch (n, c, h, w) with its own random
+        transformation.
+
+        Returns:
+            The augmented batch as float32
+        '''
+        mats = random_affine(len(batch), batch.shape[2:], rng, **self.params)
+        return warp_affine(batch, mats, out=out)
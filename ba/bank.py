@@ -0,0 +1,174 @@
+import ba.archive
+import ba.augment
+from functools import partial
+import multiprocessing as mp
+import numpy as np
+import os
+import scipy.misc
+
+
+class PatchBank(object):
+    '''Equally sized uint8 patches (n, 3, h, w) in a memory mapped .npy file.
+    Any number of processes can open the same bank read-only and share its
+    pages.'''
+
+    def __init__(self, path):
+        '''Opens the bank at path.
+
+        Args:
+            path (str): The path of the bank without extension
+        '''
+        self.path = path
+        self.patches = np.load(path + '.npy', mmap_mode='r')
+        self.meta = {}
+        if os.path.isfile(path + '.mp'):
+            with open(path + '.mp', 'rb') as f:
+                self.meta = ba.archive.unpackb(f.read())
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(path + '.npy')
+
+    @property
+    def shape(self):
+        return self.patches.shape[1:]
+
+    def __len__(self):
+        return self.patches.shape[0]
+
+    def __getitem__(self, idx):
+        return self.patches[idx]
+
+    def gather(self, idx, out=None, scale=1 / 255):
+        '''Assembles the patches at idx as float32.
+
+        Args:
+            idx (ndarray): The indices of the patches
+            out (ndarray, optional): Write into this array
+            scale (float, optional): Multiply the values with scale
+
+        Returns:
+            The float32 patches
+        '''
+        if out is None:
+            out = np.empty((len(idx), ) + self.shape, dtype=np.float32)
+        out[...] = self.patches[idx]
+        out *= scale
+        return out
+
+
+class PatchBankWriter(object):
+    '''Creates a PatchBank. The bank only appears under its path once the
+    writer is closed, so readers never see a half written bank.'''
+
+    def __init__(self, path, n, shape, meta=None):
+        '''Constructs a new PatchBankWriter
+
+        Args:
+            path (str): The path of the bank without extension
+            n (int): The count of patches
+            shape (tuple): The shape (3, h, w) of a single patch
+            meta (dict, optional): msgpack-able metadata, e.g. an index
+        '''
+        self.path = path
+        self.meta = {} if meta is None else meta
+        dirname = os.path.dirname(path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        self._tmp = '{}.{}.tmp.npy'.format(path, os.getpid())
+        self.patches = np.lib.format.open_memmap(
+            self._tmp, mode='w+', dtype=np.uint8, shape=(n, ) + tuple(shape))
+
+    def __setitem__(self, idx, patches):
+        '''Stores patches, floats are expected in the range [0, 1].'''
+        patches = np.asarray(patches)
+        if patches.dtype != np.uint8:
+            patches = np.clip(np.rint(patches * 255), 0, 255)
+        self.patches[idx] = patches
+
+    def close(self):
+        '''Flushes the patches and moves the bank in place.
+
+        Returns:
+            The PatchBank opened read-only
+        '''
+        self.patches.flush()
+        del self.patches
+        with open(self.path + '.mp', 'wb') as f:
+            f.write(ba.archive.packb(self.meta))
+        os.replace(self._tmp, self.path + '.npy')
+        return PatchBank(self.path)
+
+
+def imread_bgr(path):
+    '''Reads an image as float32 (h, w, 3) in BGR order, the layout of all
+    banks.'''
+    im = scipy.misc.imread(path)
+    if im.ndim == 2:
+        im = np.dstack([im] * 3)
+    return np.asarray(im[:, :, 2::-1], dtype=np.float32)
+
+
+def _sample_patches(job, shape, per_image, scale):
+    '''Samples random patches of one image, runs in the worker processes.
+
+    Returns:
+        The uint8 patches (k, 3, h, w) and their boxes (k, 4) as
+        [y, x, h, w]
+    '''
+    path, seed = job
+    im = imread_bgr(path)
+    h, w = im.shape[:2]
+    if per_image == 0:
+        boxes = np.array([[0, 0, h, w]])
+    else:
+        rng = np.random.RandomState(seed)
+        sizes = (rng.uniform(scale[0], scale[1], (per_image, 2)) *
+                 [h, w]).astype(int)
+        sizes = np.maximum(sizes, 1)
+        starts = (rng.random_sample((per_image, 2)) *
+                  ([h, w] - sizes + 1)).astype(int)
+        boxes = np.hstack([starts, sizes])
+    corners = np.hstack([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]])
+    patches = ba.augment.crop_and_resize(im, corners, shape)
+    return (np.clip(np.rint(patches), 0, 255).astype(np.uint8),
+            boxes.astype(np.int32))
+
+
+def build_negative_bank(path, images, shape=(224, 224), per_image=9,
+                        scale=(.01, .5), processes=None, seed=0):
+    '''Samples random patches from an image corpus in parallel and stores
+    them resized in one PatchBank. The index in the metadata maps every
+    patch back to its image and box.
+
+    Args:
+        path (str): The path of the bank without extension
+        images (list of str): The paths to the images
+        shape (tuple, optional): The shape (h, w) of the patches
+        per_image (int, optional): How many patches to sample per image, 0
+            stores every image as a whole
+        scale (tuple, optional): The range of the patch size relative to the
+            image size
+        processes (int, optional): The count of worker processes
+        seed (int, optional): The base seed, image i uses seed + i
+
+    Returns:
+        The PatchBank
+    '''
+    images = list(images)
+    count = len(images) * max(per_image, 1)
+    writer = PatchBankWriter(path, count, (3, ) + tuple(shape))
+    sample = partial(_sample_patches, shape=tuple(shape),
+                     per_image=per_image, scale=scale)
+    jobs = [(im, seed + i) for i, im in enumerate(images)]
+    index = np.empty((count, 5), dtype=np.int32)
+    it = 0
+    with mp.Pool(processes) as p:
+        for i, (patches, boxes) in enumerate(p.imap(sample, jobs,
+                                                    chunksize=8)):
+            writer[it:it + len(patches)] = patches
+            index[it:it + len(patches), 0] = i
+            index[it:it + len(patches), 1:] = boxes
+            it += len(patches)
+    writer.meta = {'images': images, 'index': ba.archive.pack_array(index)}
+    return writer.close()
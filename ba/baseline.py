@@ -99,7 +99,9 @@ class Baseline(object):
             patch_size=self.patch_size,
             ext=self.ext,
             mean=self.mean,
-            batch_size=1000)
+            batch_size=1000,
+            workers=1,
+            depth=1)
         samples, labels = flow.next()
         features = [self.features(sample) for sample in samples]
         labels = [int(i) for i in labels]
@@ -0,0 +1,212 @@
+import ba.utils
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+from glob import glob
+import threading
+
+
+def hash_bytes(*parts):
+    '''Returns the sha1 hex digest over all given parts. Arrays are hashed by
+    their shape, dtype and content, everything else by its repr.'''
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, bytes):
+            h.update(part)
+        elif isinstance(part, np.ndarray):
+            h.update(str((part.shape, part.dtype.str)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+_file_hashes = {}
+
+
+def hash_file(path, blocksize=2**20):
+    '''Returns the sha1 hex digest of a files content. The result is memoized
+    by path, size and mtime so big caffemodels are only read once.'''
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if stamp not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+        _file_hashes[stamp] = h.hexdigest()
+    return _file_hashes[stamp]
+
+
+class InferenceCache(object):
+    '''A persistent, content addressed cache for per image inference results.
+    Every entry is one npz file, the least recently used entries are evicted
+    as soon as the cache grows over its size bound.'''
+
+    def __init__(self, root, maxbytes=20 * 2**30):
+        '''Constructs a new InferenceCache
+
+        Args:
+            root (str): The directory of the cache
+            maxbytes (int, optional): The size bound in bytes
+        '''
+        self.root = os.path.normpath(root) + '/'
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        ba.utils.touch(self.root)
+        self.size = sum(os.path.getsize(p) for p in self._entries())
+
+    def _entries(self):
+        return glob(self.root + '*/*.npz')
+
+    def _path(self, key):
+        return '{}{}/{}.npz'.format(self.root, key[:2], key)
+
+    def key(self, content, weights, deploy, **preprocessing):
+        '''Builds the key for one image.
+
+        Args:
+            content (str): The hash of the image content
+            weights (str): The path to the weights
+            deploy (str): The path to the deploy prototxt
+            preprocessing: Everything else influencing the output
+
+        Returns:
+            The key
+        '''
+        return hash_bytes(content, hash_file(weights), hash_file(deploy),
+                          *[(k, preprocessing[k])
+                            for k in sorted(preprocessing)])
+
+    def get(self, key):
+        '''Returns the cached entry as dict of arrays or None.'''
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                entry = {k: npz[k] for k in npz.files}
+        except (OSError, IOError, ValueError):
+            self.misses += 1
+            return None
+        # Mark as recently used
+        os.utime(path, None)
+        self.hits += 1
+        return entry
+
+    def put(self, key, **entry):
+        '''Stores the arrays of an entry.'''
+        path = ba.utils.touch(self._path(key))
+        tmp = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp, **entry)
+        os.replace(tmp, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.maxbytes:
+            self.evict()
+
+    def evict(self, fraction=0.9):
+        '''Removes the least recently used entries until the cache is at
+        fraction of its size bound.'''
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if self.size <= fraction * self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        '''Returns a string with the hit and miss statistics.'''
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return ('Inference cache {}: {} hits, {} misses ({:.1f}%), '
+                '{} evicted, {:.1f} MB'.format(
+                    self.root, self.hits, self.misses, rate, self.evictions,
+                    self.size / 2**20))
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class LRUCache(object):
+    '''A thread safe in memory cache for tuples of arrays, bounded by the
+    bytes of the stored arrays. The least recently used entries are dropped
+    first.'''
+
+    def __init__(self, maxbytes=2**30):
+        '''Constructs a new LRUCache
+
+        Args:
+            maxbytes (int, optional): The size bound in bytes
+        '''
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns the cached entry or None.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        '''Stores a tuple of arrays. Entries bigger than the bound are not
+        stored at all.'''
+        nbytes = sum(v.nbytes for v in value)
+        if nbytes > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.maxbytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.size -= dropped
+                self.evictions += 1
+
+    def stats(self):
+        '''Returns a string with the hit and miss statistics.'''
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return ('Memory cache: {} hits, {} misses ({:.1f}%), {} evicted, '
+                '{} entries, {:.1f} MB'.format(
+                    self.hits, self.misses, rate, self.evictions, len(self),
+                    self.size / 2**20))
+
+
+_shared_caches = {}
+
+
+def shared_lru(name, maxbytes):
+    '''Returns the LRUCache registered under name in this process, so all
+    data layers of a solver share it. The first call sets the bound.'''
+    if name not in _shared_caches:
+        _shared_caches[name] = LRUCache(maxbytes)
+    return _shared_caches[name]
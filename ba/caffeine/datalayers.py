@@ -3,37 +3,134 @@
     fcn.berkeleyvision.org
 '''
 from ba import BA_ROOT
+from ba.maskarchive import MaskArchive
+import ba.cache
 import ba.utils
+import ba.workers
 import caffe
 import numpy as np
+import os
 from PIL import Image
 import random
 import scipy.misc
 import yaml
 
 
-class TextListLayer(caffe.Layer):
+class SharedMemoryDataLayer(caffe.Layer):
+    '''Base class for data layers whose loading runs in worker processes,
+    outside of the GIL of the solver. The workers write whole batches into a
+    ring of shared memory slots, reshape only claims the next ready slot and
+    forward copies it into the tops.
+
+    Subclasses implement load_setup(params), top_shapes() and
+    produce(arrays, rng). The param_str keys workers, depth (the count of
+    slots in the ring), seed and log_every configure the pool. The average
+    time spent waiting for data is printed every log_every iterations.
+
+    Layers with variable top shapes return the largest shapes from
+    top_shapes, write every batch into the leading part of the slot arrays,
+    see view, and return what batch_shapes needs from produce.
+    '''
+    numbered = False
+
     def setup(self, bottom, top):
         params = eval(self.param_str)
+        self.workers = params.get('workers', 2)
+        self.depth = params.get('depth', 4)
+        self.seed = params.get('seed', None)
+        self.log_every = params.get('log_every', 1000)
+        self.load_setup(params)
+        self.shapes, dtypes = zip(*self.top_shapes())
+
+        if len(top) != len(self.shapes):
+            raise Exception('Need to define {} tops.'.format(
+                len(self.shapes)))
+        # data layers have no bottoms
+        if len(bottom) != 0:
+            raise Exception("Do not define a bottom.")
+
+        self.iteration = 0
+        self.wait_time = 0.0
+        self.batch = None
+        self.pool = ba.workers.SharedBatchPool(
+            self.produce, self.shapes, dtypes, workers=self.workers,
+            depth=self.depth, seed=self.seed, numbered=self.numbered)
+
+    def load_setup(self, params):
+        '''Reads the parameters of the layer, runs before the workers are
+        forked.'''
+        raise NotImplementedError
+
+    def top_shapes(self):
+        '''Returns a list of (shape, dtype), one for every top.'''
+        raise NotImplementedError
+
+    def produce(self, arrays, rng):
+        '''Fills the arrays of one batch slot, runs in the workers.'''
+        raise NotImplementedError
+
+    def batch_shapes(self, meta):
+        '''Returns the top shapes of a batch from the metadata produce
+        returned for it. Fixed shape layers keep their top_shapes.'''
+        return self.shapes
+
+    @staticmethod
+    def view(array, shape):
+        '''Returns the leading part of a slot array as an array of shape,
+        where batches smaller than the slot are written.'''
+        return array.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+
+    def reshape(self, bottom, top):
+        # The shapes of a batch are only known once it is claimed. Caffe
+        # also reshapes once during net setup, the batch claimed then is
+        # the first one fed.
+        if self.batch is None:
+            waited = self.pool.wait_time
+            arrays, meta = self.pool.claim()
+            self.wait_time = self.pool.wait_time - waited
+            self.batch = [self.view(array, shape) for array, shape in
+                          zip(arrays, self.batch_shapes(meta))]
+        for blob, array in zip(top, self.batch):
+            if tuple(blob.shape) != array.shape:
+                blob.reshape(*array.shape)
+
+    def forward(self, bottom, top):
+        if self.batch is None:
+            self.reshape(bottom, top)
+        for blob, array in zip(top, self.batch):
+            blob.data[...] = array
+        self.batch = None
+        self.pool.release()
+
+        self.iteration += 1
+        if self.log_every and self.iteration % self.log_every == 0:
+            print('{}: waited {:.2f} ms per iteration for data'.format(
+                type(self).__name__,
+                1000 * self.pool.wait_time / self.iteration))
+
+    def backward(self, top, propagate_down, bottom):
+        pass
+
+
+class TextListLayer(SharedMemoryDataLayer):
+    numbered = True
+
+    def load_setup(self, params):
         self.splitfile = params['splitfile']
         self.images = params['images']
         self.ext = params.get('extension', 'jpg')
         self.batch_size = params.get('batch_size', 20)
         self.patch_size = params.get('patch_size', 500)
-        self.idx = 0
 
         with open(self.splitfile, 'r') as f:
             self.imlist = [l[:-1] for l in f.readlines() if l.strip()]
 
-    def reshape(self, bottom, top):
-        top[0].reshape(self.batch_size, 3, self.patch_size[0],
-                       self.patch_size[1])
-
-    def backward(self, top, propagate_down, bottom):
-        pass
+    def top_shapes(self):
+        return [((self.batch_size, 3, self.patch_size, self.patch_size),
+                 np.float32)]
 
     def imread(self, path):
-        _inp = np.empty((3, self.patch_size, self.patch_size),
+        _inp = np.zeros((3, self.patch_size, self.patch_size),
                         dtype=np.float32)
         im = scipy.misc.imread(path)
         scaling = self.patch_size / max(im.shape[:2])
@@ -47,20 +144,17 @@ class TextListLayer(caffe.Layer):
         _inp = _inp[:, :, ::-1]
         return _inp
 
-    def forward(self, bottom, top):
+    def produce(self, arrays, rng, batch):
+        # Batch b holds the images from b * batch_size on, in list order
+        start = batch * self.batch_size
         for i in range(self.batch_size):
-            im = self.imread(
-                self.images + self.imlist[self.idx] + '.' + self.ext)
-            top[0].data[i, ...] = im
-
-            self.idx += 1
-            if self.idx == len(self.indices):
-                self.idx = 0
+            idx = (start + i) % len(self.imlist)
+            arrays[0][i] = self.imread(
+                self.images + self.imlist[idx] + '.' + self.ext)
 
 
-class SingleImageLayer(caffe.Layer):
-    def setup(self, bottom, top):
-        params = eval(self.param_str)
+class SingleImageLayer(SharedMemoryDataLayer):
+    def load_setup(self, params):
         self.images = params['images']
         self.ext = params.get('extension', 'jpg')
         self.batch_size = params.get('batch_size', 20)
@@ -79,6 +173,7 @@ class SingleImageLayer(caffe.Layer):
         with open(self.splitfile, 'r') as f:
             imlist = [l[:-1] for l in f.readlines() if l.strip()]
 
+        # The layer runs the augmenting workers itself
         self.flow = ba.utils.SamplesGenerator(
             self.slicefile,
             imlist,
@@ -88,50 +183,86 @@ class SingleImageLayer(caffe.Layer):
             patch_size=self.patch_size,
             ext=self.ext,
             mean=self.mean,
-            batch_size=self.batch_size)
+            batch_size=self.batch_size,
+            start=False)
 
+    def top_shapes(self):
         # two tops: data and label
-        if len(top) != 2:
-            raise Exception("Need to define two tops: data and label.")
-        # data layers have no bottoms
-        if len(bottom) != 0:
-            raise Exception("Do not define a bottom.")
+        return [((self.batch_size, 3) + tuple(self.patch_size), np.float32),
+                ((self.batch_size, 1), np.float32)]
 
-    def reshape(self, bottom, top):
-        top[0].reshape(
-            self.batch_size, 3, self.patch_size[0], self.patch_size[1])
-        top[1].reshape(self.batch_size, 1)
+    def produce(self, arrays, rng):
+        return self.flow._produce(arrays, rng)
 
-    def forward(self, bottom, top):
-        # assign output
-        x, y = self.flow.next()
-        filled = x.shape[0]
-        top[0].data[:filled, ...] = x
-        top[1].data[:filled, ...] = y[..., np.newaxis]
-
-        while filled < self.batch_size:
-            x, y = self.flow.next()
-            filling = x.shape[0]
-            if filling + filled >= self.batch_size:
-                rem = self.batch_size - filled
-                top[0].data[filled:, ...] = x[:rem, ...]
-                top[1].data[filled:, ...] = y[:rem, np.newaxis]
-            else:
-                top[0].data[filled:filled + filling, ...] = x[...]
-                top[1].data[filled:filled + filling, ...] = x[..., np.newaxis]
-            filled += filling
 
-    def backward(self, top, propagate_down, bottom):
-        pass
+def image_sizes(images, indices, extension,
+                cachedir=BA_ROOT + 'data/tmp/sizeindex/'):
+    '''Returns the (height, width) of all images. Only the image headers
+    are read and the result is kept on disk for the next run.
 
+    Args:
+        images (str): The directory of the images
+        indices (list of str): The image names
+        extension (str): The image extension
+        cachedir (str, optional): Where the size indices are kept
 
-class SegDataLayer(caffe.Layer):
+    Returns:
+        The ndarray (len(indices), 2) of sizes
     '''
+    path = '{}{}.mp'.format(cachedir, ba.cache.hash_bytes(
+        os.path.abspath(images), extension, indices))
+    if os.path.isfile(path):
+        return np.array(ba.utils.load(path), dtype=int).reshape(-1, 2)
+    sizes = []
+    for idx in indices:
+        with Image.open('{}/{}.{}'.format(images, idx, extension)) as im:
+            sizes.append([im.size[1], im.size[0]])
+    ba.utils.touch(cachedir)
+    ba.utils.save(path, sizes)
+    return np.array(sizes, dtype=int).reshape(-1, 2)
+
+
+def size_buckets(sizes, batch_size):
+    '''Groups images of similar size into buckets of batch_size images.
+
+    Args:
+        sizes (ndarray): The (height, width) of every image
+        batch_size (int): The count of images per bucket
+
+    Returns:
+        The list of index arrays, one per bucket
     '''
-    def setup(self, bottom, top):
-        params = eval(self.param_str)
+    # Sort by aspect ratio first, then by area
+    order = np.lexsort((sizes[:, 0] * sizes[:, 1],
+                        np.round(sizes[:, 0] / sizes[:, 1], 1)))
+    return [order[i:i + batch_size]
+            for i in range(0, len(order), batch_size)]
+
+
+def bucket_shape(sizes, pad_to):
+    '''Returns the padded (height, width) of a bucket, the largest size
+    rounded up to a multiple of pad_to.'''
+    return tuple(int(n) for n in -(-sizes.max(axis=0) // pad_to) * pad_to)
+
+
+class SegDataLayer(SharedMemoryDataLayer):
+    '''Feeds (image, label) pairs. The workers decode and pad the batches
+    and keep decoded pairs in a byte bounded LRU cache each, cache_mb is
+    split between them. The param_str key prefetch is the old name of depth.
+
+    With seg_batch > 1 the images are grouped into buckets of similar size.
+    Every bucket is one batch, padded with the mean and the ignore label 255
+    to the largest image of the bucket rounded up to a multiple of pad_to.
+    The padded shapes are fixed per bucket and snap to a small set of
+    multiples of pad_to, the tops are only reshaped when the shape changes.
+    The slots hold the largest bucket.
+    '''
+    numbered = True
+
+    def load_setup(self, params):
         self.images = params['images']
         self.labels = params['labels']
+        self.label_archive = None
         self.splitfile = params['splitfile']
         if isinstance(params['mean'], str):
             self.mean = np.load(params['mean'])
@@ -139,16 +270,20 @@ class SegDataLayer(caffe.Layer):
             self.mean = np.array(params['mean'])
         self.extension = params.get('extension', 'jpg')
         self.random = params.get('randomize', True)
-        self.seed = params.get('seed', None)
-
-        # two tops: data and label
-        if len(top) != 2:
-            raise Exception("Need to define two tops: data and label.")
-        # data layers have no bottoms
-        if len(bottom) != 0:
-            raise Exception("Do not define a bottom.")
+        if self.seed is None:
+            # The workers derive the order of the buckets from it
+            self.seed = random.randrange(2**31 - self.workers)
+        if 'depth' not in params:
+            self.depth = params.get('prefetch', self.depth)
+        self.seg_batch = params.get('seg_batch', 1)
+        self.pad_to = params.get('pad_to', 32 if self.seg_batch > 1 else 1)
+        self.cache = ba.cache.shared_lru(
+            'datalayers',
+            params.get('cache_mb', 2048) * 2**20 // max(1, self.workers))
+        self.cache_tag = (type(self).__name__, self.images, self.labels,
+                          self.extension, ba.cache.hash_bytes(self.mean))
+        self._permutation = (None, None)
 
-        self.idx = 0
         # load indices for images and labels
         self.indices = open(self.splitfile, 'r').read().splitlines()
 
@@ -156,34 +291,72 @@ class SegDataLayer(caffe.Layer):
         if 'train' not in self.splitfile:
             self.random = False
 
-        # randomization: seed and pick
-        if self.random:
-            random.seed(self.seed)
-            self.idx = random.randint(0, len(self.indices) - 1)
-
-    def reshape(self, bottom, top):
-        # load image + label image pair
-        self.data = self.load_image(self.indices[self.idx])
-        self.label = self.load_label(self.indices[self.idx])
-        # reshape tops to fit (leading 1 is for batch dimension)
-        top[0].reshape(1, *self.data.shape)
-        top[1].reshape(1, *self.label.shape)
-
-    def forward(self, bottom, top):
-        # assign output
-        top[0].data[...] = self.data
-        top[1].data[...] = self.label
-
-        # pick next input
-        if self.random:
-            self.idx = random.randint(0, len(self.indices) - 1)
+        sizes = image_sizes(self.images, self.indices, self.extension)
+        if self.seg_batch > 1:
+            buckets = size_buckets(sizes, self.seg_batch)
         else:
-            self.idx += 1
-            if self.idx == len(self.indices):
-                self.idx = 0
+            buckets = [[i] for i in range(len(self.indices))]
+        self.buckets = [[self.indices[i] for i in bucket]
+                        for bucket in buckets]
+        self.bucket_shapes = [bucket_shape(sizes[bucket], self.pad_to)
+                              for bucket in buckets]
 
-    def backward(self, top, propagate_down, bottom):
-        pass
+    def top_shapes(self):
+        # two tops: data and label
+        shape = tuple(np.max(self.bucket_shapes, axis=0))
+        return [((self.seg_batch, 3) + shape, np.float32),
+                ((self.seg_batch, 1) + shape, np.uint8)]
+
+    def batch_shapes(self, meta):
+        return [(self.seg_batch, 3) + tuple(meta),
+                (self.seg_batch, 1) + tuple(meta)]
+
+    def _bucket(self, batch):
+        '''Returns the number of the bucket fed as batch. The order only
+        depends on the seed, so all workers agree on it.'''
+        n = len(self.buckets)
+        if not self.random:
+            return batch % n
+        if self.seg_batch == 1:
+            return np.random.RandomState([self.seed, batch]).randint(n)
+        # A new permutation of the buckets every epoch
+        epoch, position = divmod(batch, n)
+        if self._permutation[0] != epoch:
+            self._permutation = (epoch, np.random.RandomState(
+                [self.seed, epoch]).permutation(n))
+        return self._permutation[1][position]
+
+    def produce(self, arrays, rng, batch):
+        '''Writes the padded data and label of a bucket into the slot, the
+        last bucket is also filled up to seg_batch images.
+
+        Returns:
+            The padded (height, width) of the batch
+        '''
+        b = self._bucket(batch)
+        shape = self.bucket_shapes[b]
+        data, label = [self.view(array, s) for array, s in
+                       zip(arrays, self.batch_shapes(shape))]
+        data.fill(0)
+        label.fill(255)
+        for i, idx in enumerate(self.buckets[b]):
+            d, l = self.load_pair(idx)
+            data[i, :, :d.shape[1], :d.shape[2]] = d
+            label[i, :, :l.shape[1], :l.shape[2]] = l
+        if self.log_every and (batch + 1) % self.log_every == 0:
+            print(self.cache.stats())
+        return shape
+
+    def load_pair(self, idx):
+        '''Returns the preprocessed image and label, from the cache if
+        possible.'''
+        key = self.cache_tag + (idx, )
+        pair = self.cache.get(key)
+        if pair is None:
+            data = self.load_image(idx)
+            pair = (data, self.load_label(idx, data.shape[1:]))
+            self.cache.put(key, pair)
+        return pair
 
     def load_image(self, idx):
         '''
@@ -203,13 +376,19 @@ class SegDataLayer(caffe.Layer):
         in_ = in_.transpose((2, 0, 1))
         return in_
 
-    def load_label(self, idx):
+    def load_label(self, idx, shape):
         '''
         Load label image as 1 x height x width integer array of label indices.
-        The leading singleton dimension is required by the loss.
+        The leading singleton dimension is required by the loss. The labels
+        are either a directory of png files or a MaskArchive.
         '''
-        label = scipy.misc.imread('{}/{}.png'.format(self.labels, idx))
-        label = (label / 255).astype(np.uint8)
+        if self.labels.endswith('.archive'):
+            if self.label_archive is None:
+                self.label_archive = MaskArchive(self.labels)
+            label = self.label_archive.union(idx).dense(np.uint8)
+        else:
+            label = scipy.misc.imread('{}/{}.png'.format(self.labels, idx))
+            label = (label / 255).astype(np.uint8)
         label = label[np.newaxis, ...]
         return label
 
@@ -217,14 +396,13 @@ class SegDataLayer(caffe.Layer):
 class PosPatchDataLayer(SegDataLayer):
     '''
     '''
-    def setup(self, bottom, top):
-        super().setup(bottom, top)
-
-        with open(self.labels, 'r') as f:
+    def load_setup(self, params):
+        with open(params['labels'], 'r') as f:
             self.slices = yaml.load(f)
+        super().load_setup(params)
 
-    def load_label(self, idx):
-        label = np.zeros(self.data.shape[1:], dtype=np.uint8)
+    def load_label(self, idx, shape):
+        label = np.zeros(shape, dtype=np.uint8)
         label[self.slices[idx]].fill(1)
         label = label[np.newaxis, ...]
         return label
@@ -1,3 +1,7 @@
+from functools import partial
+import multiprocessing as mp
+
+
 def convert_to_FCN(new_net, old_net, new_params, old_params):
     fc_params = {pr: (old_net.params[pr][0].data,
                       old_net.params[pr][1].data) for pr in old_params}
@@ -17,3 +21,116 @@ def convert_to_FCN(new_net, old_net, new_params, old_params):
         conv_params[pr_conv][0].flat = fc_params[pr][0].flat
         conv_params[pr_conv][1][...] = fc_params[pr][1]
     return new_net
+
+
+def kernel_shapes(modeldef, new_params):
+    '''Reads the kernel sizes of convolution layers from a model definition
+    without instantiating the net.
+
+    Args:
+        modeldef (str): The path to the (FCN) prototxt
+        new_params (list): The names of the convolution layers
+
+    Returns:
+        dict of layer name to (kernel height, kernel width)
+    '''
+    from caffe.proto import caffe_pb2
+    from google.protobuf import text_format
+    net = caffe_pb2.NetParameter()
+    with open(modeldef, 'r') as f:
+        text_format.Merge(f.read(), net)
+    shapes = {}
+    for layer in net.layer:
+        if layer.name not in new_params:
+            continue
+        conv = layer.convolution_param
+        ks = list(conv.kernel_size) or [1]
+        kh = conv.kernel_h or ks[0]
+        kw = conv.kernel_w or ks[-1]
+        shapes[layer.name] = (kh, kw)
+    return shapes
+
+
+def _set_blob_shape(blob, shape):
+    blob.ClearField('num')
+    blob.ClearField('channels')
+    blob.ClearField('height')
+    blob.ClearField('width')
+    blob.shape.ClearField('dim')
+    blob.shape.dim.extend(shape)
+
+
+def _blob_shape(blob):
+    if blob.HasField('shape'):
+        return list(blob.shape.dim)
+    return [blob.num, blob.channels, blob.height, blob.width]
+
+
+def convert_caffemodel_to_FCN(weights, new_weights, kernels, new_params,
+                              old_params):
+    '''Converts the fully connected layers of a caffemodel into convolutions
+    by rewriting the serialized protobuf. All other layers are passed
+    through untouched, so no net is instantiated.
+
+    Args:
+        weights (str): The path to the source caffemodel
+        new_weights (str): The path for the converted caffemodel
+        kernels (dict): Kernel sizes of the new layers, see kernel_shapes
+        new_params (list): The names of the convolution layers
+        old_params (list): The names of the fully connected layers
+
+    Returns:
+        The path of the converted caffemodel
+    '''
+    from caffe.proto import caffe_pb2
+    net = caffe_pb2.NetParameter()
+    with open(weights, 'rb') as f:
+        net.ParseFromString(f.read())
+    renames = dict(zip(old_params, new_params))
+    for layer in net.layer:
+        if layer.name not in renames:
+            continue
+        layer.name = renames[layer.name]
+        layer.type = 'Convolution'
+        kh, kw = kernels[layer.name]
+        wshape = _blob_shape(layer.blobs[0])
+        nout = wshape[0]
+        count = 1
+        for d in wshape[1:]:
+            count *= d
+        # Row major weights of (nout, C * kh * kw) are (nout, C, kh, kw)
+        _set_blob_shape(layer.blobs[0], [nout, count // (kh * kw), kh, kw])
+        if len(layer.blobs) > 1:
+            _set_blob_shape(layer.blobs[1], [nout])
+    with open(new_weights, 'wb') as f:
+        f.write(net.SerializeToString())
+    return new_weights
+
+
+def _convert_pair(pair, kernels, new_params, old_params):
+    return convert_caffemodel_to_FCN(pair[0], pair[1], kernels, new_params,
+                                     old_params)
+
+
+def bulk_convert_to_FCN(pairs, modeldef, new_params, old_params,
+                        processes=None):
+    '''Converts many caffemodels in parallel. The FCN definition is only read
+    once.
+
+    Args:
+        pairs (list): Tuples of (source caffemodel, target caffemodel)
+        modeldef (str): The path to the FCN prototxt
+        new_params (list): The names of the convolution layers
+        old_params (list): The names of the fully connected layers
+        processes (int, optional): The count of worker processes
+
+    Returns:
+        The list of written caffemodels
+    '''
+    kernels = kernel_shapes(modeldef, new_params)
+    convert = partial(_convert_pair, kernels=kernels, new_params=new_params,
+                      old_params=old_params)
+    if processes == 1 or len(pairs) < 2:
+        return [convert(pair) for pair in pairs]
+    with mp.Pool(processes) as p:
+        return p.map(convert, pairs)
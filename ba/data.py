@@ -1,6 +1,7 @@
 from ba import BA_ROOT
 import argparse
 from ba.pascalpart import PascalPartSet
+from ba.pascalpart import build_queries
 import ba.utils
 
 DATASET = 'pascpart'
@@ -34,17 +35,63 @@ class Generator(ba.utils.NotifierClass):
         parser.add_argument('--parts', type=str, nargs='+',
                             metavar='part')
         parser.add_argument('--default', action='store_true')
+        parser.add_argument('--colour', action='store_true',
+                            help='Jitter the colours of the augmentations')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='The count of processes for the build')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only rebuild outputs whose inputs changed')
+        parser.add_argument('--masks', type=str, default='png',
+                            choices=['archive', 'png'],
+                            help='Store the masks in archives or png files')
         args = parser.parse_args(args=argv)
         self.classes = args.classes
         self.parts = args.parts
         self.combine = args.combine
         self.defaulting = args.default
+        self.colour = args.colour
+        self.processes = args.processes
+        self.incremental = args.incremental
+        self.masks = args.masks
 
     def run(self):
         '''Generates the training data for that experiment'''
         ppset = PascalPartSet(
             self.dataset_name, self.partset_source, classes=self.classes,
-            parts=self.parts, defaulting=self.defaulting)
+            parts=self.parts, defaulting=self.defaulting,
+            processes=self.processes, incremental=self.incremental,
+            masks=self.masks)
         ppset.segmentations(combine=self.combine)
         ppset.bounding_boxes(self.images_source, negatives=self.negatives,
-                             augment=self.naugment, combine=self.combine)
+                             augment=self.naugment, combine=self.combine,
+                             colour=self.colour)
+
+
+class MultiQueryGenerator(Generator):
+    '''Generates the data of many class and part combinations at once. The
+    annotations and images are read in a single pass and shared by all
+    queries.'''
+
+    def __init__(self, queries, argv=[], **kwargs):
+        '''Initialize the generator
+
+        Args:
+            queries (list): (classes, parts) tuples of lists
+            argv (str, optional): The options string, --classes and --parts
+                are ignored
+        '''
+        super().__init__(argv, **kwargs)
+        self.queries = queries
+
+    def run(self):
+        '''Generates the training data of all queries'''
+        sets = [PascalPartSet(self.dataset_name, self.partset_source,
+                              classes=classes, parts=parts, dolists=False,
+                              defaulting=self.defaulting,
+                              processes=self.processes,
+                              incremental=self.incremental,
+                              masks=self.masks)
+                for classes, parts in self.queries]
+        build_queries(sets, self.images_source, negatives=self.negatives,
+                      augment=self.naugment, combine=self.combine,
+                      colour=self.colour)
@@ -1,12 +1,16 @@
+import ba.archive
 import ba.utils
 from functools import lru_cache as cache
 import ba.plt
 import copy
 from matplotlib import pyplot as plt
+import multiprocessing as mp
 import numpy as np
+import os
 import skimage.transform as tf
 from scipy.ndimage import distance_transform_cdt
 from scipy.misc import imread
+from scipy.misc import imresize
 from tqdm import tqdm
 
 
@@ -187,15 +191,16 @@ def intersectArea(a, b):
 
 
 @cache(maxsize=32)
-def _generic_box(shape, scales=(2, 7, 15,), cache=True):
+def _generic_box(shape, scales=(1, 1.5, 2), ratios=(1, 4 / 3, 1.6180, 2, 2.76),
+                 basel=100):
     '''Returns a generic grid of boxes for an image. A little bit like done
     on YOLO
 
     Args:
         shape (ndarray): The shape of the image
-        scales (tupel, optional): The scales as dividents of the img size to
-            generate boxes for
-        cache (bool, optional): Whether to use the cache
+        scales (tupel, optional): The scales of the base length
+        ratios (tupel, optional): The aspect ratios
+        basel (int, optional): The base length of the boxes in pixels
 
     Returns:
         a list of regions
@@ -211,9 +216,8 @@ def _generic_box(shape, scales=(2, 7, 15,), cache=True):
     areas = []
     starts = []
     ends = []
-    basel = 100
-    scales = np.mat([1, 1.5, 2])
-    ascpect_ratios = np.mat([1, 4 / 3, 1.6180, 2, 2.76])
+    scales = np.mat(scales)
+    ascpect_ratios = np.mat(ratios)
     widths = np.dot(scales.T, ascpect_ratios).flat
     i = np.vstack(len(widths) * [widths])
     sizes = (np.vstack(([i], [i.T])).T * basel).reshape(-1, 2).astype(int)
@@ -295,18 +299,23 @@ def nms(starts, ends, scores, thresh=0.5):
     return picks
 
 
-def scoreToRegion(hm):
+def scoreToRegion(hm, thresh=0.2, nms_thresh=0.5, scales=(1, 1.5, 2),
+                  ratios=(1, 4 / 3, 1.6180, 2, 2.76)):
     '''Reudces a heatmap to a bounding box by searching through regions of the
     image generated by the generic box generator.
 
     Args:
         hm (ndarray): The map of un-normalized scores
+        thresh (float, optional): Keep boxes scoring over thresh * maximum
+        nms_thresh (float, optional): The overlap threshold of the NMS
+        scales (tupel, optional): The scales of the generic boxes
+        ratios (tupel, optional): The aspect ratios of the generic boxes
 
     Returns:
         The maximum bounding box (x_start, y_start, x_end, y_end)
     '''
-    scales = (2, 5, 7,)
-    starts, ends, areas = _generic_box(hm.shape, scales=scales)
+    starts, ends, areas = _generic_box(hm.shape, scales=tuple(scales),
+                                       ratios=tuple(ratios))
     if len(starts) == 0:
         return np.array([]), np.array([])
 
@@ -349,13 +358,13 @@ def scoreToRegion(hm):
     densities = np.divide(volumes, areas)
     # gradient_densities = np.divide(gradient_volumes, areas)
     bbscores = densities  # * gradient_densities
-    picks = bbscores > (0.2 * bbscores.max())
+    picks = bbscores > (thresh * bbscores.max())
     if any(picks):
         bbscores = bbscores[picks]
         starts = starts[picks]
         ends = ends[picks]
         # from os import _exit as e; import ipdb; ipdb.set_trace()
-        picks = nms(starts, ends, bbscores)
+        picks = nms(starts, ends, bbscores, thresh=nms_thresh)
         bbscores = bbscores[picks]
         starts = starts[picks]
         ends = ends[picks]
@@ -369,3 +378,80 @@ def scoreToRegion(hm):
         return np.concatenate((starts, ends), axis=1), bbscores
     else:
         return np.array([]), np.array([])
+
+
+def decode_score(score, imshape, upscale=32.0, **params):
+    '''Decodes the low resolution score map of a FCN into regions.
+
+    Args:
+        score (ndarray): The score map of the positive class
+        imshape (tuple): The shape (height, width) of the input image
+        upscale (float, optional): The output stride of the net. ONLY WORKS
+            AS SUCH WITH ResNet 50
+        params: Passed to scoreToRegion
+
+    Returns:
+        regions, scores
+    '''
+    upscore = np.zeros(tuple(imshape), dtype=float)
+    score = imresize(score, upscale)
+    x_stop = min(upscore.shape[0], score.shape[0])
+    y_stop = min(upscore.shape[1], score.shape[1])
+    upscore[0:x_stop, 0:y_stop] = score[0:x_stop, 0:y_stop]
+    return scoreToRegion(upscore, **params)
+
+
+def _redecode_chunk(args):
+    archive_path, chunk, params = args
+    scoreboxes = {}
+    with ba.archive.Archive(archive_path) as archive:
+        records = archive.chunk(chunk)
+        for key, (c, pos) in archive.index.items():
+            if c != chunk:
+                continue
+            record = records[pos]
+            score = ba.archive.unpack_array(record['score'])
+            regions, rscores = decode_score(score.astype(np.float32),
+                                            record['imshape'], **params)
+            scoreboxes[key] = {'region': regions.tolist(),
+                               'score': rscores.tolist()}
+    return scoreboxes
+
+
+def _params_tag(params):
+    def fmt(value):
+        if isinstance(value, (tuple, list)):
+            return ','.join('{:g}'.format(v) for v in value)
+        return '{:g}'.format(value)
+    return '_'.join(k + fmt(params[k]) for k in sorted(params))
+
+
+def redecode(archive_path, slicefile=None, processes=None, **params):
+    '''Decodes the score maps persisted during a test run again with new
+    parameters for the region extraction and evaluates the detections.
+
+    Args:
+        archive_path (str): The path to the *.scoremaps archive
+        slicefile (str, optional): The path for the seg.yaml, if given the
+            detection is evaluated
+        processes (int, optional): The count of worker processes
+        params: Passed to scoreToRegion
+
+    Returns:
+        the filename of the new ****scores.yaml File
+    '''
+    archive = ba.archive.Archive(archive_path)
+    tasks = [(archive_path, c, params) for c in range(len(archive.chunks))]
+    archive.close()
+    scores_path = '{}_{}.scores.yaml'.format(
+        os.path.splitext(archive_path)[0], _params_tag(params))
+    scoreboxes = {}
+    tqdm.write('Redecoding {} with {}'.format(archive_path, params))
+    with mp.Pool(processes) as p:
+        for res in tqdm(p.imap_unordered(_redecode_chunk, tasks),
+                        total=len(tasks)):
+            scoreboxes.update(res)
+    ba.utils.save(scores_path, scoreboxes)
+    if slicefile is not None:
+        evalDect(scores_path, slicefile)
+    return scores_path
@@ -99,6 +99,8 @@ class Experiment(ba.utils.NotifierClass):
         parser.add_argument('--tofcn', action='store_true')
         parser.add_argument('--train', action='store_true')
         parser.add_argument('--repeat', action='store_true')
+        parser.add_argument('--bulk', action='store_true',
+                            help='Convert all snapshots at once (--tofcn).')
         parser.add_argument('--quiet', action='store_true')
         parser.add_argument('--bs', type=int, nargs=1, default=0,
                             metavar='count',
@@ -176,7 +178,9 @@ class Experiment(ba.utils.NotifierClass):
                           images=self.conf['images'],
                           labels=self.conf['labels'],
                           mean=self.conf['mean'],
-                          quiet=self.quiet
+                          quiet=self.quiet,
+                          inference_cache=self.conf['inference_cache'],
+                          save_scores=self.conf['save_scores']
                           )
 
         # Extra attributes for the cnn
@@ -195,7 +199,8 @@ class Experiment(ba.utils.NotifierClass):
 
         # Extra attributes for the network generator
         attrs = ['batch_size', 'patch_size', 'ppI',
-                 'images', 'negatives', 'slicefile', 'lmdb']
+                 'images', 'negatives', 'slicefile', 'lmdb',
+                 'workers', 'depth', 'seed', 'seg_batch', 'pad_to']
         for attr in attrs:
             if attr in self.conf:
                 self.cnn.generator_attr[attr] = self.conf[attr]
@@ -249,8 +254,10 @@ class Experiment(ba.utils.NotifierClass):
             modeldef = '{}{}/deploy.prototxt'.format(
                 MODELDIR, self.conf['tag'])
             orig_modeldef = modeldef.replace('FCN_', '')
-            fc_net = caffe.Net(orig_modeldef, self.cnn.net_weights, caffe.TEST)
-            self.cnn.net = caffe.Net(modeldef, caffe.TEST)
+            fc_net = ba.netrunner.NETPOOL.get(
+                orig_modeldef, self.cnn.net_weights, self.args.gpu[0])
+            self.cnn.net = ba.netrunner.NETPOOL.get(
+                modeldef, None, self.args.gpu[0])
 
             old_params = ['fc']
             new_params = ['fc_conv']
@@ -297,6 +304,9 @@ class Experiment(ba.utils.NotifierClass):
         if len(weights) < 1:
             print('No weights found for {}'.format(self.conf['tag']))
             return False
+        old_params = ['fc']
+        new_params = ['fc_conv']
+        pairs = []
         for w in weights:
             bn = os.path.basename(w)
             new_weights = new_snap_dir + 'classifier_' + bn
@@ -304,16 +314,23 @@ class Experiment(ba.utils.NotifierClass):
             if not ba.utils.query_boolean(question, default='yes',
                                           defaulting=self.args.default):
                 continue
+            if self.args.bulk:
+                pairs.append((w, new_weights))
+                continue
             print('CONVERTING ' + bn)
             old_net = caffe.Net(
                 old_model_dir + 'deploy.prototxt', w, caffe.TEST)
             new_net = caffe.Net(
                 new_model_dir + 'deploy.prototxt', w, caffe.TEST)
-            old_params = ['fc']
-            new_params = ['fc_conv']
             converted_net = ba.caffeine.surgery.convert_to_FCN(
                 new_net, old_net, new_params, old_params, new_weights)
             converted_net.save(new_weights)
+        if len(pairs) > 0:
+            print('CONVERTING {} snapshots of {}'.format(len(pairs), old_tag))
+            ba.caffeine.surgery.bulk_convert_to_FCN(
+                pairs, new_model_dir + 'deploy.prototxt', new_params,
+                old_params,
+                processes=self.args.threads if self.threaded else None)
 
     def _meta_test(self, callback=(lambda: True), doEval=True, **kwargs):
         snapdir = self.conf['snapshot_dir'].format(self.conf['tag'])
@@ -0,0 +1,397 @@
+import ba.utils
+import numpy as np
+import os
+
+
+class ScalarQuantizer(object):
+    '''Quantizes every channel of a feature vector independently to uint8.'''
+    kind = 'sq8'
+
+    def __init__(self):
+        self.low = None
+        self.scale = None
+
+    def train(self, samples):
+        '''Learns the per channel range from a sample of feature vectors.
+
+        Args:
+            samples (ndarray): Feature vectors of shape (n, channels)
+        '''
+        samples = np.asarray(samples, dtype=np.float32)
+        self.low = samples.min(axis=0)
+        high = samples.max(axis=0)
+        self.scale = np.maximum(high - self.low, 1e-8) / 255
+        return self
+
+    def encode(self, x):
+        '''Encodes feature vectors of shape (n, channels) to uint8 codes.'''
+        codes = np.rint((np.asarray(x, dtype=np.float32) - self.low) /
+                        self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        '''Reconstructs approximate feature vectors from codes.'''
+        return codes.astype(np.float32) * self.scale + self.low
+
+    def scores(self, codes, w, b=0, chunk=4096):
+        '''Computes approximate linear scores w·x + b directly on the codes.
+        The codes are converted to float in chunks of rows, so the
+        temporary stays small.
+
+        Args:
+            codes (ndarray): The codes of shape (n, channels)
+            w (ndarray): The weight vector of the linear head
+            b (float, optional): The bias of the linear head
+            chunk (int, optional): The count of rows scored at once
+
+        Returns:
+            The approximate scores of shape (n,)
+        '''
+        w = np.asarray(w, dtype=np.float32)
+        ws = w * self.scale
+        out = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], chunk):
+            np.dot(codes[start:start + chunk], ws,
+                   out=out[start:start + chunk])
+        out += float(w.dot(self.low)) + b
+        return out
+
+    def code_size(self, channels):
+        return channels
+
+    def state(self):
+        return {'low': self.low, 'scale': self.scale}
+
+    def load_state(self, state):
+        self.low = state['low']
+        self.scale = state['scale']
+        return self
+
+
+class ProductQuantizer(object):
+    '''Splits feature vectors into m subvectors and quantizes each of them to
+    one of 256 centroids learned by k-means.'''
+    kind = 'pq'
+
+    def __init__(self, m=64, iterations=20, seed=None):
+        '''Constructs a new ProductQuantizer.
+
+        Args:
+            m (int, optional): The count of subspaces, has to divide the
+                count of channels
+            iterations (int, optional): The k-means iterations
+            seed (int, optional): The seed for the centroid initialization
+        '''
+        self.m = m
+        self.k = 256
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+
+    def train(self, samples):
+        '''Learns the codebooks from a sample of feature vectors.
+
+        Args:
+            samples (ndarray): Feature vectors of shape (n, channels)
+        '''
+        samples = np.asarray(samples, dtype=np.float32)
+        n, channels = samples.shape
+        if channels % self.m != 0:
+            raise ValueError('{} subspaces do not divide {} channels'.format(
+                self.m, channels))
+        rng = np.random.RandomState(self.seed)
+        dsub = channels // self.m
+        self.centroids = np.empty((self.m, self.k, dsub), dtype=np.float32)
+        for sub in range(self.m):
+            subsamples = samples[:, sub * dsub:(sub + 1) * dsub]
+            self.centroids[sub] = _kmeans(subsamples, self.k,
+                                          self.iterations, rng)
+        return self
+
+    def encode(self, x, chunk=4096):
+        '''Encodes feature vectors of shape (n, channels) to (n, m) codes.'''
+        x = np.asarray(x, dtype=np.float32)
+        dsub = self.centroids.shape[2]
+        codes = np.empty((x.shape[0], self.m), dtype=np.uint8)
+        for start in range(0, x.shape[0], chunk):
+            block = x[start:start + chunk]
+            for sub in range(self.m):
+                subx = block[:, sub * dsub:(sub + 1) * dsub]
+                codes[start:start + chunk, sub] = _nearest(
+                    subx, self.centroids[sub])
+        return codes
+
+    def decode(self, codes):
+        '''Reconstructs approximate feature vectors from codes.'''
+        parts = [self.centroids[sub][codes[:, sub]] for sub in range(self.m)]
+        return np.concatenate(parts, axis=1)
+
+    def scores(self, codes, w, b=0):
+        '''Computes approximate linear scores w·x + b directly on the codes
+        through a lookup table of the centroid scores for every subspace.
+
+        Args:
+            codes (ndarray): The codes of shape (n, m)
+            w (ndarray): The weight vector of the linear head
+            b (float, optional): The bias of the linear head
+
+        Returns:
+            The approximate scores of shape (n,)
+        '''
+        w = np.asarray(w, dtype=np.float32).reshape(self.m, 1, -1)
+        lut = (self.centroids * w).sum(axis=2)
+        return lut[np.arange(self.m), codes].sum(axis=1) + b
+
+    def code_size(self, channels):
+        return self.m
+
+    def state(self):
+        return {'centroids': self.centroids}
+
+    def load_state(self, state):
+        self.centroids = state['centroids']
+        self.m, self.k = self.centroids.shape[:2]
+        return self
+
+
+QUANTIZERS = {'sq8': ScalarQuantizer, 'pq': ProductQuantizer}
+
+
+def _nearest(x, centroids):
+    '''Returns the index of the nearest centroid for every row of x.'''
+    dists = (x * x).sum(axis=1)[:, np.newaxis] - 2 * x.dot(centroids.T)
+    dists += (centroids * centroids).sum(axis=1)[np.newaxis, :]
+    return dists.argmin(axis=1)
+
+
+def _kmeans(x, k, iterations, rng):
+    '''Plain Lloyd k-means, returns the (k, dim) centroids.'''
+    if len(x) < k:
+        x = x[rng.randint(0, len(x), k)]
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        # Respawn empty clusters at random samples
+        empty = np.flatnonzero(~filled)
+        if len(empty) > 0:
+            centroids[empty] = x[rng.randint(0, len(x), len(empty))]
+    return centroids
+
+
+class FeatureBank(object):
+    '''A bank of spatial feature cells (e.g. res5c) for a whole corpus. The
+    full precision features stay on disk, while the compressed codes are small
+    enough to be scanned in memory.'''
+
+    def __init__(self, path):
+        '''Opens (or prepares) the bank at path.
+
+        Args:
+            path (str): The directory of the bank
+        '''
+        self.path = os.path.normpath(path) + '/'
+        self.index = {'channels': 0, 'images': [], 'quantizer': None}
+        self.quantizer = None
+        self._features = None
+        self._codes = None
+        if os.path.isfile(self.path + 'index.mp'):
+            self.load()
+
+    @property
+    def channels(self):
+        return self.index['channels']
+
+    @property
+    def ncells(self):
+        if len(self.index['images']) == 0:
+            return 0
+        _, offset, h, w = self.index['images'][-1]
+        return offset + h * w
+
+    def load(self):
+        '''Loads the index and the quantizer of this bank.'''
+        self.index = ba.utils.load(self.path + 'index.mp')
+        self.index = {k.decode() if isinstance(k, bytes) else k: v
+                      for k, v in self.index.items()}
+        self.index['images'] = [
+            (n.decode() if isinstance(n, bytes) else n, o, h, w)
+            for n, o, h, w in self.index['images']]
+        kind = self.index['quantizer']
+        if isinstance(kind, bytes):
+            kind = kind.decode()
+        if kind is not None:
+            state = np.load(self.path + 'quantizer.npz')
+            self.quantizer = QUANTIZERS[kind]().load_state(state)
+
+    def save_index(self):
+        ba.utils.save(self.path + 'index.mp', self.index)
+
+    def writer(self):
+        '''Returns a writer appending full precision features to this bank.'''
+        return FeatureBankWriter(self)
+
+    @property
+    def features(self):
+        '''The memory mapped full precision features (ncells, channels).'''
+        if self._features is None:
+            self._features = np.memmap(self.path + 'features.f32',
+                                       dtype=np.float32, mode='r',
+                                       shape=(self.ncells, self.channels))
+        return self._features
+
+    @property
+    def codes(self):
+        '''The compressed codes (ncells, code_size), loaded into memory.'''
+        if self._codes is None:
+            self._codes = np.load(self.path + 'codes.npy')
+        return self._codes
+
+    def compress(self, quantizer, nsamples=100000, seed=None, chunk=65536):
+        '''Trains a quantizer on a random sample of cells and encodes all
+        cells of this bank.
+
+        Args:
+            quantizer (ScalarQuantizer or ProductQuantizer): The quantizer
+            nsamples (int, optional): The count of cells to train on
+            seed (int, optional): The seed for sampling the cells
+            chunk (int, optional): The count of cells encoded at once
+        '''
+        rng = np.random.RandomState(seed)
+        nsamples = min(nsamples, self.ncells)
+        picks = np.sort(rng.choice(self.ncells, nsamples, replace=False))
+        quantizer.train(self.features[picks])
+        codes = np.empty((self.ncells, quantizer.code_size(self.channels)),
+                         dtype=np.uint8)
+        for start in range(0, self.ncells, chunk):
+            codes[start:start + chunk] = quantizer.encode(
+                self.features[start:start + chunk])
+        np.save(self.path + 'codes.npy', codes)
+        np.savez(self.path + 'quantizer.npz', **quantizer.state())
+        self.quantizer = quantizer
+        self._codes = codes
+        self.index['quantizer'] = quantizer.kind
+        self.save_index()
+
+    def locate(self, cells):
+        '''Maps flat cell indices to (image name, row, column).'''
+        offsets = np.array([o for _, o, _, _ in self.index['images']])
+        imidx = np.searchsorted(offsets, cells, side='right') - 1
+        located = []
+        for cell, i in zip(cells, imidx):
+            name, offset, h, w = self.index['images'][i]
+            y, x = divmod(int(cell) - offset, w)
+            located.append((name, y, x))
+        return located
+
+    def exact_scores(self, w, b=0, cells=None, chunk=65536):
+        '''Scores cells with the full precision features read from disk.
+
+        Args:
+            w (ndarray): The weight vector of the linear head
+            b (float, optional): The bias of the linear head
+            cells (ndarray, optional): Only score those cells
+
+        Returns:
+            The scores
+        '''
+        w = np.asarray(w, dtype=np.float32)
+        if cells is not None:
+            order = np.argsort(cells)
+            scores = np.empty(len(cells), dtype=np.float32)
+            scores[order] = self.features[cells[order]].dot(w) + b
+            return scores
+        scores = np.empty(self.ncells, dtype=np.float32)
+        for start in range(0, self.ncells, chunk):
+            scores[start:start + chunk] = self.features[
+                start:start + chunk].dot(w) + b
+        return scores
+
+    def search(self, w, b=0, topk=100, rerank=1000):
+        '''Finds the best scoring cells for a linear head. Scores are
+        approximated on the codes and only the best rerank candidates are
+        scored again with the full precision features.
+
+        Args:
+            w (ndarray): The weight vector of the linear head
+            b (float, optional): The bias of the linear head
+            topk (int, optional): The count of cells to return
+            rerank (int, optional): The count of candidates to re-rank
+
+        Returns:
+            The cell indices and their exact scores, best first
+        '''
+        approx = self.quantizer.scores(self.codes, w, b)
+        rerank = min(max(rerank, topk), len(approx))
+        candidates = np.argpartition(-approx, rerank - 1)[:rerank]
+        scores = self.exact_scores(w, b, cells=candidates)
+        order = np.argsort(-scores)[:topk]
+        return candidates[order], scores[order]
+
+
+class FeatureBankWriter(object):
+    '''Appends the full precision feature maps of images to a FeatureBank.'''
+
+    def __init__(self, bank):
+        self.bank = bank
+        ba.utils.touch(bank.path)
+        self.file = open(bank.path + 'features.f32', 'wb')
+        bank.index = {'channels': 0, 'images': [], 'quantizer': None}
+        self.offset = 0
+
+    def add(self, name, fmap):
+        '''Adds the feature map of one image.
+
+        Args:
+            name (str): The index of the image
+            fmap (ndarray): The features of shape (channels, h, w)
+        '''
+        channels, h, w = fmap.shape
+        if self.bank.index['channels'] == 0:
+            self.bank.index['channels'] = channels
+        cells = np.ascontiguousarray(
+            fmap.reshape(channels, -1).T, dtype=np.float32)
+        self.file.write(cells.tobytes())
+        self.bank.index['images'].append((name, self.offset, h, w))
+        self.offset += h * w
+
+    def close(self):
+        self.file.close()
+        self.bank.save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def recall_at(bank, w, b=0, topk=100, rerank=1000, exact=None):
+    '''Measures which fraction of the exact top k cells the compressed search
+    returns.
+
+    Args:
+        bank (FeatureBank): A compressed bank
+        w (ndarray): The weight vector of the linear head
+        b (float, optional): The bias of the linear head
+        topk (int, optional): The count of cells compared
+        rerank (int, optional): The count of re-ranked candidates
+        exact (ndarray, optional): Precomputed exact scores
+
+    Returns:
+        The recall in the range [0, 1]
+    '''
+    if exact is None:
+        exact = bank.exact_scores(w, b)
+    truth = np.argpartition(-exact, topk - 1)[:topk]
+    found, _ = bank.search(w, b, topk=topk, rerank=rerank)
+    return len(np.intersect1d(truth, found)) / topk
+
+
+def compression_ratio(bank):
+    '''Returns the ratio of full precision bytes to code bytes.'''
+    return bank.channels * 4 / bank.codes.shape[1]
@@ -0,0 +1,83 @@
+from caffe.io import array_to_datum
+import lmdb
+import queue
+import threading
+import traceback
+
+
+class LMDBWriter(object):
+    '''Writes caffe Datum records into an LMDB from a background thread. The
+    producer only hands over arrays, serialization and the batched write
+    transactions happen in the thread.'''
+
+    def __init__(self, path, map_size=2**40, txn_size=1000, depth=2048):
+        '''Opens the LMDB and starts the writer thread.
+
+        Args:
+            path (str): The path of the LMDB directory
+            map_size (int, optional): The maximal size of the database, only
+                address space is reserved
+            txn_size (int, optional): The count of records per transaction
+            depth (int, optional): How many records may wait for the thread
+        '''
+        self.path = path
+        self.txn_size = txn_size
+        self.count = 0
+        self.error = None
+        self.env = lmdb.open(path, map_size=map_size)
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def put(self, key, image, label):
+        '''Queues a record.
+
+        Args:
+            key (str): The key, the records are read in key order
+            image (ndarray): The uint8 image (c, h, w)
+            label (int): The label
+        '''
+        if self.error is not None:
+            raise RuntimeError('LMDB writer failed:\n' + self.error)
+        self.queue.put((key, image, label))
+
+    def _write(self):
+        txn = self.env.begin(write=True)
+        pending = 0
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.error is not None:
+                continue
+            key, image, label = record
+            try:
+                datum = array_to_datum(image, int(label))
+                txn.put(key.encode('ascii'), datum.SerializeToString())
+                pending += 1
+                self.count += 1
+                if pending == self.txn_size:
+                    txn.commit()
+                    txn = self.env.begin(write=True)
+                    pending = 0
+            except Exception:
+                # Keep draining, so the producer never blocks on the queue
+                self.error = traceback.format_exc()
+        if self.error is None:
+            txn.commit()
+        else:
+            txn.abort()
+
+    def close(self):
+        '''Writes the remaining records and closes the LMDB.'''
+        self.queue.put(None)
+        self.thread.join()
+        self.env.close()
+        if self.error is not None:
+            raise RuntimeError('LMDB writer failed:\n' + self.error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,175 @@
+from ba.maskarchive import MaskArchive
+import ba.archive
+import ba.cache
+import os
+
+
+class Manifest(object):
+    '''A build manifest. Maps every output artifact to the content hash of
+    the inputs it was built from and a small msgpack-able result, e.g. the
+    bounding boxes of an image. A rebuild only recomputes the artifacts
+    whose inputs changed and takes the recorded results for the rest.'''
+
+    def __init__(self, path):
+        '''Opens the manifest at path, it is created on the first save.
+
+        Args:
+            path (str): The path of the msgpack file
+        '''
+        self.path = path
+        self.entries = self._read()
+        self._changes = {}
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'rb') as f:
+            return ba.archive.unpackb(f.read())
+
+    @staticmethod
+    def digest(*inputs):
+        '''Hashes the inputs of an artifact, see ba.cache.hash_bytes.'''
+        return ba.cache.hash_bytes(*inputs)
+
+    def fresh(self, key, digest):
+        '''Returns whether the artifact was built from inputs with digest.'''
+        return key in self.entries and self.entries[key][0] == digest
+
+    def get(self, key):
+        '''Returns the recorded result of an artifact.'''
+        return self.entries[key][1]
+
+    def stale(self, prefix, stems, digests, directories=()):
+        '''Returns the rows of a per row artifact that have to be rebuilt,
+        those whose digest changed or of which a recorded output is missing.
+        Their files are removed, like the recorded outputs of rows that left
+        the artifact, so no outputs of a previous build are left behind.
+
+        Args:
+            prefix (str): The artifact, the key of a row is prefix + its
+                image name
+            stems (list of str): The image names of all rows
+            digests (list): The digests of the inputs of the rows
+            directories (list of str, optional): The output directories, see
+                _row_outputs
+
+        Returns:
+            The indices of the stale rows
+        '''
+        keys = [prefix + stem for stem in stems]
+        current = _row_outputs(directories, stems)
+        stale = [i for i, (key, digest) in enumerate(zip(keys, digests))
+                 if not self.fresh(key, digest) or
+                 not set(self.get(key)[1]) <= set(current[stems[i]])]
+        for i in stale:
+            _remove_outputs(current[stems[i]])
+        for key in set(self.entries) - set(keys):
+            if key.startswith(prefix):
+                # The row left the artifact
+                _remove_outputs(self.get(key)[1])
+                self.discard(key)
+        return stale
+
+    def record_rows(self, prefix, stems, digests, results, directories=()):
+        '''Records the rebuilt rows of a per row artifact with their outputs
+        and saves the manifest.
+
+        Args:
+            prefix (str): The artifact, see stale
+            stems (list of str): The image names of all rows
+            digests (list): The digests of the inputs of the rows
+            results (dict): Per index of a rebuilt row its msgpack-able
+                result and its mask records by directory, None for png files
+            directories (list of str, optional): The output directories
+        '''
+        if len(results) > 0:
+            built = _row_outputs(directories, stems, archives=False)
+        for i, (value, records) in results.items():
+            outputs = built[stems[i]]
+            if records is not None:
+                outputs = outputs + [directory[:-1] + '.archive'
+                                     for directory in directories
+                                     if directory in records]
+            self.record(prefix + stems[i], digests[i],
+                        [value, sorted(outputs)])
+        self.save()
+
+    def result(self, prefix, stem):
+        '''Returns the recorded result of a row, see record_rows.'''
+        return self.get(prefix + stem)[0]
+
+    def record(self, key, digest, value=None):
+        '''Records that an artifact was built from inputs with digest.'''
+        self.entries[key] = [digest, value]
+        self._changes[key] = self.entries[key]
+
+    def discard(self, key):
+        '''Removes the record of an artifact that is not built anymore.'''
+        self.entries.pop(key, None)
+        self._changes[key] = None
+
+    def save(self):
+        '''Writes the recorded changes. Entries recorded by other manifests
+        on the same path in the meantime are kept.'''
+        if len(self._changes) == 0:
+            return
+        entries = self._read()
+        for key, entry in self._changes.items():
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(ba.archive.packb(entries))
+        os.replace(tmp, self.path)
+        self.entries = entries
+        self._changes = {}
+
+
+def _row_outputs(directories, stems, archives=True):
+    '''Returns the outputs of the rows in the output directories, the files
+    idx.png and idx_*.png and the MaskArchives next to the directories that
+    hold a record of idx. Every directory is listed once.
+
+    Args:
+        directories (list of str): The output directories
+        stems (list of str): The image names of all rows, a file is matched
+            to the longest of them
+        archives (bool, optional): Whether to look into the archives
+
+    Returns:
+        A dict of the sorted output paths per image name
+    '''
+    outputs = {stem: [] for stem in stems}
+    for directory in directories:
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                stem, ext = os.path.splitext(name)
+                if ext != '.png':
+                    continue
+                # Strip the _classname and _number suffixes
+                while stem not in outputs and '_' in stem:
+                    stem = stem.rsplit('_', 1)[0]
+                if stem in outputs:
+                    outputs[stem].append(directory + name)
+        path = directory[:-1] + '.archive'
+        if archives and os.path.isfile(path):
+            with MaskArchive(path) as archive:
+                for stem in archive.keys():
+                    if stem in outputs:
+                        outputs[stem].append(path)
+    return {stem: sorted(paths) for stem, paths in outputs.items()}
+
+
+def _remove_outputs(paths):
+    '''Removes the files of a row before it is rebuilt, so no patches or
+    negatives of the previous build are left behind. The archives are
+    rewritten as a whole.'''
+    for path in paths:
+        if path.endswith('.archive'):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
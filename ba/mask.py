@@ -0,0 +1,126 @@
+import numpy as np
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class Mask(object):
+    '''A binary mask stored as bit-packed rows, 1/64 of the memory of a
+    float64 mask. Union, intersection, area and bounding box work on the
+    packed form, the dense mask is only decoded on request.'''
+
+    def __init__(self, bits, shape):
+        '''Constructs a new Mask
+
+        Args:
+            bits (ndarray): The packed rows (h, ceil(w / 8)) as uint8
+            shape (tuple): The shape (h, w) of the dense mask
+        '''
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, mask):
+        '''Packs a dense mask, everything non zero is set.'''
+        mask = np.asarray(mask) != 0
+        return cls(np.packbits(mask, axis=1), mask.shape)
+
+    @classmethod
+    def empty(cls, shape):
+        return cls(np.zeros((shape[0], -(-shape[1] // 8)), dtype=np.uint8),
+                   shape)
+
+    @classmethod
+    def union_of(cls, masks):
+        '''Returns the union of an iterable of masks.'''
+        masks = list(masks)
+        bits = masks[0].bits.copy()
+        for mask in masks[1:]:
+            masks[0]._check(mask)
+            bits |= mask.bits
+        return cls(bits, masks[0].shape)
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError('Masks of shape {} and {} do not match.'.format(
+                self.shape, other.shape))
+
+    def __or__(self, other):
+        self._check(other)
+        return Mask(self.bits | other.bits, self.shape)
+
+    def __and__(self, other):
+        self._check(other)
+        return Mask(self.bits & other.bits, self.shape)
+
+    def __eq__(self, other):
+        return (isinstance(other, Mask) and self.shape == other.shape and
+                np.array_equal(self.bits, other.bits))
+
+    def __bool__(self):
+        return bool(self.bits.any())
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    @property
+    def area(self):
+        '''The count of set pixels.'''
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def bbox(self):
+        '''Returns the bounding box as tuple of slices, like
+        scipy.ndimage.find_objects, or None for an empty mask.'''
+        rows = np.flatnonzero(self.bits.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(np.unpackbits(
+            np.bitwise_or.reduce(self.bits[rows[0]:rows[-1] + 1], axis=0)))
+        return (slice(int(rows[0]), int(rows[-1]) + 1),
+                slice(int(cols[0]), int(cols[-1]) + 1))
+
+    def dense(self, dtype=bool):
+        '''Decodes the mask.
+
+        Args:
+            dtype (optional): The dtype of the result
+
+        Returns:
+            The dense mask (h, w)
+        '''
+        mask = np.unpackbits(self.bits, axis=1)[:, :self.shape[1]]
+        return mask.astype(dtype, copy=False)
+
+    def pack(self):
+        '''Compresses the mask further to the bits inside its bounding box.
+
+        Returns:
+            A msgpack-able dict with the bounding box [y0, x0, y1, x1] and bits
+        '''
+        bb = self.bbox()
+        if bb is None:
+            return {'bbox': [0, 0, 0, 0], 'bits': b''}
+        rows = np.unpackbits(self.bits[bb[0]], axis=1)[:, bb[1]]
+        return {'bbox': [bb[0].start, bb[1].start, bb[0].stop, bb[1].stop],
+                'bits': np.packbits(rows).tobytes()}
+
+    @classmethod
+    def unpack(cls, packed, shape):
+        '''Reverses pack.
+
+        Args:
+            packed (dict): The packed mask
+            shape (tuple): The shape (h, w) of the dense mask
+
+        Returns:
+            The Mask
+        '''
+        mask = cls.empty(shape)
+        y0, x0, y1, x1 = packed['bbox']
+        size = (y1 - y0) * (x1 - x0)
+        if size > 0:
+            bits = np.unpackbits(np.frombuffer(packed['bits'], dtype=np.uint8))
+            rows = np.zeros((y1 - y0, shape[1]), dtype=np.uint8)
+            rows[:, x0:x1] = bits[:size].reshape(y1 - y0, x1 - x0)
+            mask.bits[y0:y1] = np.packbits(rows, axis=1)
+        return mask
@@ -0,0 +1,129 @@
+from ba.mask import Mask
+import ba.archive
+import os
+from scipy.misc import imsave
+
+
+class MaskArchiveWriter(object):
+    '''Writes the bit-packed masks of one output directory into a single
+    archive instead of one png per object. Every image id gets one record
+    with its objects in order.'''
+
+    def __init__(self, path):
+        '''Constructs a new MaskArchiveWriter
+
+        Args:
+            path (str): The path of the archive file
+        '''
+        self.writer = ba.archive.ArchiveWriter(path, chunksize=64)
+
+    def put(self, idx, record):
+        '''Adds the record of an image.
+
+        Args:
+            idx (str): The image id
+            record (dict): The record with the shape (h, w) of the image,
+                whether the objects are cropped patches and the objects as
+                [name, packed mask] pairs, see PascalPart.records
+        '''
+        self.writer.put(idx, record)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MaskArchive(object):
+    '''Random access to the masks of a MaskArchiveWriter archive by image id
+    and object number.'''
+
+    def __init__(self, path):
+        '''Opens the archive at path.'''
+        self.archive = ba.archive.Archive(path)
+
+    def __len__(self):
+        return len(self.archive)
+
+    def __contains__(self, idx):
+        return idx in self.archive
+
+    def keys(self):
+        return self.archive.keys()
+
+    def record(self, idx):
+        return self.archive[idx]
+
+    def objects(self, idx):
+        '''Returns the (name, Mask) pairs of all objects of an image.'''
+        record = self.archive[idx]
+        return [(name, Mask.unpack(packed, record['shape']))
+                for name, packed in record['objects']]
+
+    def mask(self, idx, number):
+        '''Returns the Mask of object number of an image.'''
+        record = self.archive[idx]
+        return Mask.unpack(record['objects'][number][1], record['shape'])
+
+    def union(self, idx):
+        '''Returns the union of all objects of an image, the label of the
+        whole image.'''
+        record = self.archive[idx]
+        if len(record['objects']) == 0:
+            return Mask.empty(record['shape'])
+        return Mask.union_of(mask for _, mask in self.objects(idx))
+
+    def images(self, idx):
+        '''Returns the images the png export writes for an image id, the
+        union per name or every object cropped to its bounding box.
+
+        Returns:
+            A list of (file name without extension, image) pairs
+        '''
+        record = self.archive[idx]
+        groups = {}
+        for name, mask in self.objects(idx):
+            groups.setdefault(name, []).append(mask)
+        images = []
+        for name, masks in groups.items():
+            if not record['crop']:
+                images.append((name, Mask.union_of(masks).dense()))
+                continue
+            for it, mask in enumerate(masks):
+                bb = mask.bbox()
+                if bb is not None:
+                    images.append(('{}_{}'.format(name, it),
+                                   mask.dense(int)[bb]))
+        return images
+
+    def export(self, directory, keys=None):
+        '''Writes the masks as the png files the segmentation and bounding box
+        stages used to write.
+
+        Args:
+            directory (str): The output directory
+            keys (list, optional): Only export these image ids
+
+        Returns:
+            The count of written files
+        '''
+        os.makedirs(directory, exist_ok=True)
+        count = 0
+        for idx in self.keys() if keys is None else keys:
+            for name, im in self.images(idx):
+                imsave(os.path.join(directory, name + '.png'), im)
+                count += 1
+        return count
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
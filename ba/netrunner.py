@@ -1,12 +1,16 @@
 from ba import BA_ROOT
 from ba.set import SetList
+import ba.archive
+import ba.cache
 import ba.utils
 from ba.utils import grouper
 import caffe
 from caffe.proto import caffe_pb2
 from caffe.io import array_to_datum
+from collections import OrderedDict
 import copy
 import datetime
+import hashlib
 import numpy as np
 import os
 from os.path import normpath
@@ -67,10 +71,82 @@ class SolverSpec(ba.utils.Bunch):
                         f.write('{}: {}\n'.format(key, value))
 
 
+class NetPool(object):
+    '''Keeps loaded caffe.Nets alive between snapshots. Nets are keyed by the
+    content of their model definition and the device, so a new snapshot only
+    copies its weights into an existing net.'''
+
+    def __init__(self, maxsize=4):
+        '''Constructs a new NetPool
+
+        Args:
+            maxsize (int, optional): The count of nets kept alive
+        '''
+        self.maxsize = maxsize
+        self.nets = OrderedDict()
+
+    def get(self, model, weights=None, gpu=None):
+        '''Returns a net for the model definition with the given weights.
+
+        Args:
+            model (str): The path to the model definition
+            weights (str, optional): The path to the weights. If None the
+                caller is going to overwrite the parameters itself.
+            gpu (int, optional): The ID of the GPU to use, CPU if None
+
+        Returns:
+            The caffe.Net
+        '''
+        with open(model, 'rb') as f:
+            key = (hashlib.sha1(f.read()).hexdigest(), gpu)
+        if gpu is None:
+            caffe.set_mode_cpu()
+        else:
+            caffe.set_device(gpu)
+            caffe.set_mode_gpu()
+        if key in self.nets:
+            net, loaded = self.nets.pop(key)
+        else:
+            net, loaded = caffe.Net(model, caffe.TEST), None
+        if weights is not None:
+            stamp = (weights, os.path.getmtime(weights))
+            if stamp != loaded:
+                net.copy_from(weights)
+            loaded = stamp
+        else:
+            # Parameters are going to be modified by the caller
+            loaded = None
+        self.nets[key] = (net, loaded)
+        while len(self.nets) > self.maxsize:
+            self.nets.popitem(last=False)
+        return net
+
+    def clear(self):
+        self.nets.clear()
+
+
+NETPOOL = NetPool()
+
+
+def reshape_blob(blob, shape):
+    '''Reshapes a blob only if its shape actually differs.
+
+    Returns:
+        True if the blob was reshaped
+    '''
+    if tuple(blob.data.shape) == tuple(shape):
+        return False
+    blob.reshape(*shape)
+    return True
+
+
 class NetRunner(ba.utils.NotifierClass):
     '''A Wrapper for a caffe Network'''
     buildroot = BA_ROOT + 'data/models/'
     resultroot = BA_ROOT + 'data/results/'
+    # The layout of the InferenceCache entries, bumped whenever a field is
+    # added, so entries of older runs are misses instead of KeyErrors
+    cache_format = 2
     resultDB = BA_ROOT + 'data/results/experimentDB.yaml'
 
     def __init__(self, name, **kwargs):
@@ -104,13 +180,46 @@ class NetRunner(ba.utils.NotifierClass):
             'trainset': '',
             'valset': '',
             'meanarray': None,
-            'quiet': False
+            'quiet': False,
+            'inference_cache': '',
+            'save_scores': False
             }
         self.__dict__.update(defaults)
         for (attr, value) in kwargs.items():
             if attr in defaults:
                 setattr(self, attr, value)
         self.name = name
+        self._cache = None
+        self._score_writer = None
+
+    @property
+    def cache(self):
+        '''The InferenceCache if inference_cache is set, else None.'''
+        if self._cache is None and self.inference_cache:
+            self._cache = ba.cache.InferenceCache(self.inference_cache)
+        return self._cache
+
+    def cache_key(self, content, mean, **preprocessing):
+        '''Builds the InferenceCache key for one input of the current net.
+
+        Args:
+            content (str): The hash of the input content
+            mean: The mean used for preprocessing
+            preprocessing: Other parameters influencing the output
+
+        Returns:
+            The key
+        '''
+        return self.cache.key(content, self.net_weights,
+                              self.dir + 'deploy.prototxt',
+                              runner=type(self).__name__,
+                              mean=ba.cache.hash_bytes(np.asarray(mean)),
+                              format=self.cache_format, **preprocessing)
+
+    def log_cache_stats(self):
+        if self.cache is not None:
+            print(self.cache.stats())
+            self.cache.reset_stats()
 
     @property
     def name(self):
@@ -182,9 +291,7 @@ class NetRunner(ba.utils.NotifierClass):
             gpu (int): The ID of the GPU to use
         '''
         self.net_weights = weights
-        caffe.set_device(gpu)
-        caffe.set_mode_gpu()
-        self.net = caffe.Net(model, weights, caffe.TEST)
+        self.net = NETPOOL.get(model, weights, gpu)
 
     def create_solver(self, solverpath, weights, gpu):
         '''Creates a Solver to Train a network
@@ -242,9 +349,9 @@ class NetRunner(ba.utils.NotifierClass):
             The results the data of the first output
         '''
         if data.ndim == 3:
-            self.net.blobs['data'].reshape(1, *data.shape)
+            reshape_blob(self.net.blobs['data'], (1, ) + data.shape)
         else:
-            self.net.blobs['data'].reshape(*data.shape)
+            reshape_blob(self.net.blobs['data'], data.shape)
         self.net.blobs['data'].data[...] = data
 
         # run net and take argmax for prediction
@@ -350,9 +457,16 @@ class NetRunner(ba.utils.NotifierClass):
             split (str): The split (test|train|deploy)
         '''
         ba.utils.touch(self.dir)
-        with open(self.dir + split + '.prototxt', 'w') as f:
-            f.write(str(self.net_generator(self.generator_params(split),
-                                           self.generator_switches)))
+        path = self.dir + split + '.prototxt'
+        proto = str(self.net_generator(self.generator_params(split),
+                                       self.generator_switches))
+        # Leave unchanged definitions untouched
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                if f.read() == proto:
+                    return
+        with open(path, 'w') as f:
+            f.write(proto)
 
     def write_solver(self):
         '''Writes the solver definition to disk.'''
@@ -408,12 +522,28 @@ class NetRunner(ba.utils.NotifierClass):
             ba.eval.evalDect(scores_path, slicefile)
 
     def forward_batch(self, path_batch, mean=None):
-        datas = []
-        max_h = 500
-        max_w = 500
+        scoreboxes = {}
+        keys = {}
+        paths = []
         for path in path_batch:
             if path is None:
                 continue
+            bn = os.path.basename(os.path.splitext(path)[0])
+            if self.cache is not None:
+                keys[bn] = self.cache_key(ba.cache.hash_file(path), mean,
+                                          mode='batch')
+                entry = self._from_cache(keys[bn], bn)
+                if entry is not None:
+                    scoreboxes[bn] = entry
+                    continue
+            paths.append(path)
+        if len(paths) == 0:
+            return scoreboxes
+
+        datas = []
+        max_h = 500
+        max_w = 500
+        for path in paths:
             data, im = self.load_img(path, mean=mean)
             # ADAPTIVE VERSION
             if data.shape[1] > max_h:
@@ -423,38 +553,59 @@ class NetRunner(ba.utils.NotifierClass):
             datas.append(data)
 
         bs = len(datas)
-        self.net.blobs['data'].reshape(bs, 3, max_h, max_w)
+        reshape_blob(self.net.blobs['data'], (bs, 3, max_h, max_w))
         for i, data in enumerate(datas):
             shape = data.shape[1:]
             self.net.blobs['data'].data[i, :, 0:shape[0], 0:shape[1]] = data
         scores = self.net.forward()
         scores = scores[:, 1, ...]
-        scoreboxes = {}
-        for path, score, data in zip(path_batch, scores, datas):
+        for path, score, data in zip(paths, scores, datas):
             bn = os.path.basename(os.path.splitext(path)[0])
             regions, rscores = self._postprocess_single_output(bn, score,
                                                                data.shape[1:])
             scoreboxes[bn] = {'region': regions, 'score': rscores}
+            if bn in keys:
+                self._to_cache(keys[bn], score, data.shape[1:], regions,
+                               rscores)
         return scoreboxes
 
     def forward_lmdb(self):
         import ba.eval
         shapes = ba.utils.load(os.path.splitext(
             self.testset.source)[0] + '_sizes.yaml')
-            
+        tstr = time.strftime('%b%d_%H:%M_', time.localtime())
+        path_split = os.path.split(os.path.normpath(self.results))
+        self._open_score_writer('{}/{}{}.scores.yaml'.format(
+            path_split[0], tstr, path_split[1]))
+
         for idxs in grouper(tqdm(self.testset), self.batch_size, None):
             scoreboxes = {}
+            # The net has to be forwarded anyway to advance the data layer,
+            # the cache saves the decoding of the outputs.
             self.net.forward()
+            inputs = next(iter(self.net.blobs.values())).data
             scores = self.net.blobs[self.net.outputs[0]].data[:, 1, ...]
             for i, bn in enumerate(idxs):
                 if bn is None:
                     continue
                 shape = shapes[bn]
+                key = None
+                if self.cache is not None:
+                    key = self.cache_key(ba.cache.hash_bytes(inputs[i]),
+                                         False, mode='lmdb', shape=shape)
+                    entry = self._from_cache(key, bn)
+                    if entry is not None:
+                        scoreboxes[bn] = entry
+                        continue
                 score = scores[i, ...]
                 regions, rscores = self._postprocess_single_output(
                     bn, score, shape)
                 scoreboxes[bn] = {'region': regions, 'score': rscores}
+                if key is not None:
+                    self._to_cache(key, score, shape, regions, rscores)
             self.append_finds(scoreboxes)
+        self._close_score_writer()
+        self.log_cache_stats()
 
     def forward_single(self, path, mean=None):
         '''Will forward one single path-image from the source set and saves the
@@ -469,14 +620,58 @@ class NetRunner(ba.utils.NotifierClass):
         '''
         if mean is None:
             mean, meanpath = self.get_mean()
+        bn = os.path.basename(os.path.splitext(path)[0])
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(ba.cache.hash_file(path), mean,
+                                 mode='single')
+            entry = self._from_cache(key, bn)
+            if entry is not None:
+                return {bn: entry}
         data, im = self.load_img(path, mean=mean)
         score = self.forward(data)
         score = score[0][1, ...]
-        bn = os.path.basename(os.path.splitext(path)[0])
         regions, rscores = self._postprocess_single_output(bn, score,
                                                            data.shape[1:])
+        if key is not None:
+            self._to_cache(key, score, data.shape[1:], regions, rscores)
         return {bn: {'region': regions, 'score': rscores}}
 
+    def _from_cache(self, key, bn):
+        '''Looks up the decoded output of one input in the cache.
+
+        Returns:
+            The scorebox or None if missed
+        '''
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        self._persist_score(bn, entry['score'], entry['imshape'])
+        return {'region': entry['region'], 'score': entry['rscore']}
+
+    def _to_cache(self, key, score, imshape, regions, rscores):
+        self.cache.put(key, score=score, imshape=np.array(imshape),
+                       region=regions, rscore=rscores)
+
+    def _persist_score(self, bn, score, imshape):
+        '''Adds a raw score map to the score map archive of the running
+        forward pass, if save_scores is set.'''
+        if self._score_writer is not None:
+            self._score_writer.put(bn, {
+                'score': ba.archive.pack_array(score, dtype=np.float16),
+                'imshape': [int(x) for x in imshape]})
+
+    def _open_score_writer(self, scores_path):
+        if self.save_scores:
+            self._score_writer = ba.archive.ArchiveWriter(
+                scores_path[:-len('.scores.yaml')] + '.scoremaps')
+
+    def _close_score_writer(self):
+        if self._score_writer is not None:
+            self._score_writer.close()
+            print('Score maps saved to {}'.format(self._score_writer.path))
+            self._score_writer = None
+
     def _postprocess_single_output(self, bn, score, imshape):
         # bn_hm = self.heatmaps + bn
         # imsave(bn_hm + '.png', score)
@@ -484,14 +679,8 @@ class NetRunner(ba.utils.NotifierClass):
         # score = skimage.img_as_float(score)
         # bn_ov = self.heatmaps[:-1] + '_overlays/' + bn
         # ba.plt.apply_overlay(im, score, bn_ov + '.png')
-        upscore = np.zeros(imshape, dtype=float)
-        # ONLY WORKS AS SUCH WITH ResNet 50
-        score = imresize(score, 32.0)
-        x_stop = min(upscore.shape[0], score.shape[0])
-        y_stop = min(upscore.shape[1], score.shape[1])
-        upscore[0:x_stop, 0:y_stop] = score[0:x_stop, 0:y_stop]
-        regions, rscores = ba.eval.scoreToRegion(upscore)
-        return regions, rscores
+        self._persist_score(bn, score, imshape)
+        return ba.eval.decode_score(score, imshape)
 
     def forward_list(self, setlist, reset_net=True, shout=False):
         '''Will forward a whole setlist through the network. Will default to the
@@ -530,6 +719,7 @@ class NetRunner(ba.utils.NotifierClass):
             forward = forward_single
 
         ba.utils.rm(BA_ROOT + 'current_finds.csv')
+        self._open_score_writer(scores_path)
 
         print('Forwarding for {} at {} list {}'.format(
             self.name, weightname, setlist.source))
@@ -539,7 +729,9 @@ class NetRunner(ba.utils.NotifierClass):
                 scoreboxes.update(res)
                 if shout:
                     self.append_finds(res)
+        self._close_score_writer()
         self.save_scoreboxes(scores_path, scoreboxes)
+        self.log_cache_stats()
         if not self.quiet:
             self.notify('Forwarded {} for weights {} of {}'.format(
                 setlist.source, weightname, self.name))
@@ -616,6 +808,43 @@ class NetRunner(ba.utils.NotifierClass):
             # txn.commit()
             # env.close()
 
+    def outputs_to_bank(self, setlist=None, maxlength=800, quantizer='pq',
+                        nsamples=100000, **kwargs):
+        '''Forwards a set and stores the outputs as a FeatureBank. Other than
+        outputs_to_lmdb the full precision features only live on disk and a
+        compressed copy is used for scoring.
+
+        Args:
+            setlist (SetList, optional): The set to forward
+            maxlength (int, optional): The longer side of the scaled inputs
+            quantizer (str, optional): 'pq' or 'sq8'
+            nsamples (int, optional): The count of cells to train the
+                quantizer on
+            kwargs: Passed to the quantizer
+
+        Returns:
+            The FeatureBank
+        '''
+        import ba.featurebank
+        if setlist is None:
+            setlist = self.testset
+        self.create_net(
+            self.dir + 'deploy.prototxt', self.net_weights, self.gpu[0])
+        bank = ba.featurebank.FeatureBank(
+            os.path.splitext(setlist.source)[0] + '_bank')
+        mean, meanpath = self.get_mean()
+        with bank.writer() as writer:
+            for idx in tqdm(setlist):
+                inputs, _ = self.load_img(idx, mean=mean)
+                scaling = maxlength / max(inputs.shape[1:])
+                inputs = imresize(inputs, scaling)
+                inputs = inputs.transpose((2, 0, 1))
+                outputs = self.forward(inputs)
+                writer.add(idx, outputs[0])
+        bank.compress(ba.featurebank.QUANTIZERS[quantizer](**kwargs),
+                      nsamples=nsamples)
+        return bank
+
 
 class SlidingFCNPartRunner(NetRunner):
     '''A subclass of FCNPartRunner that forwards images in a sliding window kind
@@ -678,13 +907,22 @@ class SlidingFCNPartRunner(NetRunner):
         '''
         if mean is None:
             mean, meanpath = self.get_mean()
+        bn = os.path.basename(os.path.splitext(idx)[0])
+        kernel_sizes = [50, 100, 250]
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(ba.cache.hash_file(idx), mean,
+                                 stride=self.stride, kernel_sizes=kernel_sizes)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return {bn: {'region': entry['region'].tolist(),
+                             'score': float(entry['rscore'])}}
         data, im = self.load_img(idx, mean=mean)
         data = data.transpose((1, 2, 0))
         hm = np.zeros(data.shape[:-1])
-        bn = os.path.basename(os.path.splitext(idx)[0])
         bn_hm = self.heatmaps + bn
         bn_ov = self.heatmaps[:-1] + '_overlays/' + bn
-        for ks in [50, 100, 250]:
+        for ks in kernel_sizes:
             pad = int(ks)
             padded_data = np.pad(data, ((pad, pad), (pad, pad), (0, 0)),
                                  mode='reflect')
@@ -699,5 +937,8 @@ class SlidingFCNPartRunner(NetRunner):
         hm = imresize(hm, im.shape[:-1])
         hm = skimage.img_as_float(hm)
         ba.utils.apply_overlay(im, hm, bn_ov + '.png')
-        region, rscore = ba.eval.scoreToRegion(hm, im)
+        region, rscore = ba.eval.scoreToRegion(hm)
+        if key is not None:
+            self.cache.put(key, score=hm.astype(np.float16), region=region,
+                           rscore=rscore)
         return {bn: {'region': list(region), 'score': float(rscore)}}
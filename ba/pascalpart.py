@@ -1,16 +1,366 @@
 from ba import BA_ROOT
+from ba.manifest import Manifest
+from ba.mask import Mask
+from ba.maskarchive import MaskArchive
+from ba.maskarchive import MaskArchiveWriter
 from ba.set import SetList
+from ba.workers import SharedBatchPool
+import ba.archive
+import ba.augment
+import ba.cache
 import ba.utils
 import copy
+from functools import partial
+from glob import glob
+import multiprocessing as mp
 import numpy as np
 import os.path
 import scipy.io as sio
 from scipy.misc import imread
 from scipy.misc import imsave
-import scipy.ndimage
 from tqdm import tqdm
 import collections
-import random
+import zlib
+
+
+def _compile_annotation(path):
+    '''Parses one mat file into an index record, runs in the workers.'''
+    key = os.path.splitext(os.path.basename(path))[0]
+    try:
+        mat = sio.loadmat(path)['anno'][0][0][1][0]
+    except IndexError:
+        print('PascalPart::load: given file is wrong, %s', path)
+        return key, None
+    objects = []
+    shape = None
+    for submat in mat:
+        classname, segmentation, parts = PascalPart._load_object(submat)
+        shape = segmentation.shape
+        packed = Mask.from_dense(segmentation).pack()
+        objects.append({
+            'class': str(classname),
+            'bbox': packed['bbox'],
+            'mask': packed,
+            'parts': [[str(name), Mask.from_dense(part).pack()]
+                      for name, part in parts.items()]})
+    return key, {'shape': list(shape) if shape else [0, 0],
+                 'objects': objects}
+
+
+def compile_index(source, path, extension='.mat', processes=None):
+    '''Parses all PASCAL-Part annotations once into a single archive with
+    the class names, part names, bounding boxes and packed masks of every
+    object.
+
+    Args:
+        source (str): The directory of the mat files
+        path (str): The path of the archive
+        extension (str, optional): The extension of the annotation files
+        processes (int, optional): The count of parsing processes. Inside a
+            daemonic worker, which may not have children, they are parsed
+            serially
+
+    Returns:
+        The opened ba.archive.Archive
+    '''
+    files = sorted(glob(os.path.join(source, '*' + extension)))
+    print('Compiling {} annotations of {} into {}'.format(
+        len(files), source, path))
+    writer = ba.archive.ArchiveWriter(ba.utils.touch(path), chunksize=32)
+    if mp.current_process().daemon:
+        for key, record in tqdm(map(_compile_annotation, files),
+                                total=len(files)):
+            if record is not None:
+                writer.put(key, record)
+    else:
+        with mp.Pool(processes) as p:
+            for key, record in tqdm(p.imap(_compile_annotation, files,
+                                           chunksize=16), total=len(files)):
+                if record is not None:
+                    writer.put(key, record)
+    writer.meta = {'source': os.path.abspath(source), 'files': len(files),
+                   'stamp': _stamp(files)}
+    writer.close()
+    return ba.archive.Archive(path)
+
+
+def _stamp(files):
+    '''Hashes names, sizes and modification times of files, a cheap check
+    whether an index is outdated.'''
+    stats = [os.stat(f) for f in files]
+    return ba.cache.hash_bytes([(os.path.basename(f), st.st_size,
+                                 st.st_mtime_ns)
+                                for f, st in zip(files, stats)])
+
+
+_indices = {}
+
+
+def _load_item(row, index_path, masks='png'):
+    '''Returns the PascalPart of a row. Every process opens the index on its
+    own, forked processes must not share the file offset. With masks
+    'archive' the item collects its masks as records instead of saving
+    png files.'''
+    index = None
+    if index_path is not None:
+        # A recompiled index replaces the file
+        key = (os.getpid(), index_path, os.stat(index_path).st_mtime_ns)
+        if key not in _indices:
+            _indices[key] = ba.archive.Archive(index_path)
+        index = _indices[key]
+    item = PascalPart(row, index=index)
+    if masks == 'archive':
+        item.records = {}
+    return item
+
+
+def _image_seed(idx, seed):
+    '''Derives the seed of an image from its name, independent of the order
+    the images are processed in.'''
+    return (zlib.crc32(idx.encode()) + seed) % 2**32
+
+
+def _stem(row):
+    return os.path.splitext(os.path.basename(row))[0]
+
+
+def _hash_stage(path, conf):
+    if not os.path.isfile(path):
+        return None
+    return ba.cache.hash_file(path)
+
+
+def _pack_boxes(result):
+    '''Converts the slices in a result of _bounding_box_stage or
+    _query_stage into lists for the manifest.'''
+    return [[[[s.start, s.stop] for s in bb] for bb in field]
+            if isinstance(field, list) else field for field in result]
+
+
+def _unpack_boxes(value):
+    '''Reverses _pack_boxes.'''
+    return tuple([tuple(slice(*s) for s in bb) for bb in field]
+                 if isinstance(field, list) else field for field in value)
+
+
+def _list_membership(item, classes, parts):
+    '''Returns whether an item belongs into the class and into the parts
+    list.'''
+    if len(set(classes) & item.classnames) > 0 or len(classes) < 1:
+        _, nrest = item.reduced(keep_parts=parts, keep_classes=classes)
+        return True, nrest > 0
+    return False, False
+
+
+def _save_segmentations(item, idx, targets):
+    '''Saves the part and class segmentations of a reduced item into the
+    target directories.'''
+    if 'parts' in targets:
+        item.target = targets['parts'] + idx
+        item.save(mode='parts')
+    if 'classes' in targets:
+        item.target = targets['classes'] + idx
+        item.save(mode='class')
+
+
+def _save_patches(item, idx, im, d, classes, negatives, seed):
+    '''Saves the class and part patches and the negatives of a reduced
+    item.
+
+    Returns:
+        The lists of class and part bounding boxes
+    '''
+    multpl_classes = len(classes) > 1
+
+    # Save Class patches
+    item.target = d['class_seg'] + idx
+    class_bound_boxes = item.bounding_box(mode='class')
+    item.target = d['patch_seg'] + idx
+    part_bound_boxes = item.bounding_box(mode='parts')
+    patch_bb_list = []
+    class_bb_list = []
+    for classname in classes:
+        class_target = d['class_img'] + idx
+        patch_target = d['patch_pos'] + idx
+        if multpl_classes:
+            class_target += '_' + classname
+            patch_target += '_' + classname
+        for it, bb in enumerate(class_bound_boxes[classname]):
+            class_bb_list.append(bb)
+            imsave(class_target + '_' + str(it) + '.png', im[bb])
+        for it, bb in enumerate(part_bound_boxes[classname]):
+            patch_bb_list.append(bb)
+            imsave(patch_target + '_' + str(it) + '.png', im[bb])
+
+    if len(patch_bb_list) > 0:
+        rng = np.random.RandomState(_image_seed(idx, seed))
+        _generate_negatives(d['patch_neg'] + idx, im, patch_bb_list,
+                            negatives, rng)
+    return class_bb_list, patch_bb_list
+
+
+def _list_stage(row, conf):
+    '''Returns whether a row belongs into the class and into the parts
+    list.'''
+    item = _load_item(row, conf['index'])
+    return _list_membership(item, conf['classes'], conf['parts'])
+
+
+def _segmentation_stage(row, conf):
+    '''Saves the part and class segmentations of a row.
+
+    Returns:
+        A tuple of the mask records per directory, None for png files
+    '''
+    idx = os.path.splitext(os.path.basename(row))[0]
+    item = _load_item(row, conf['index'], conf['masks'])
+    item.reduce(conf['parts'], conf['classes'], conf['combine'])
+    _save_segmentations(item, idx, conf['targets'])
+    return (item.records, )
+
+
+def _bounding_box_stage(row, conf):
+    '''Saves the class and part patches and the negatives of a row.
+
+    Returns:
+        The image name, the lists of class and part bounding boxes and the
+        mask records per directory
+    '''
+    idx = os.path.splitext(os.path.basename(row))[0]
+    item = _load_item(row, conf['index'], conf['masks'])
+    im = imread(conf['imgdir'] + idx + '.' + conf['ext'])
+    item.reduce(conf['parts'], conf['classes'], conf['combine'])
+    boxes = _save_patches(item, idx, im, conf['dirs'], conf['classes'],
+                          conf['negatives'], conf['seed'])
+    return (idx, ) + boxes + (item.records, )
+
+
+def _query_stage(work, conf):
+    '''Runs all stages of the given queries on a row. The annotation and the
+    image are read once and shared by the queries.
+
+    Args:
+        work (tuple): The row and the indices of the queries to run
+
+    Returns:
+        The image name, per query whether the row is in the class and
+        parts list and the lists of class and part bounding boxes, None for
+        the queries that did not run, and the mask records per directory
+    '''
+    row, active = work
+    idx = os.path.splitext(os.path.basename(row))[0]
+    item = _load_item(row, conf['index'], conf['masks'])
+    im = None
+    results = []
+    for q, query in enumerate(conf['queries']):
+        if q not in active:
+            results.append(None)
+            continue
+        if query['members'] is None:
+            in_class, in_parts = _list_membership(item, query['classes'],
+                                                  query['parts'])
+        else:
+            in_class, in_parts = row in query['members'], None
+        class_bbs, patch_bbs = [], []
+        if in_class:
+            reduced, _ = item.reduced(query['parts'], query['classes'],
+                                      conf['combine'])
+            _save_segmentations(reduced, idx, query['targets'])
+            if query['dirs'] is not None:
+                if im is None:
+                    im = imread(conf['imgdir'] + idx + '.' + conf['ext'])
+                class_bbs, patch_bbs = _save_patches(
+                    reduced, idx, im, query['dirs'], query['classes'],
+                    query['negatives'], query['seed'])
+        results.append((in_class, in_parts, class_bbs, patch_bbs))
+    return idx, results, item.records
+
+
+def _read_rgb(path):
+    '''Reads an image as RGB, grey images are stacked.'''
+    im = imread(path)
+    if im.ndim == 2:
+        im = np.dstack([im] * 3)
+    return im[:, :, :3]
+
+
+def _augment_batch(out, batch, imdir, stems, augmenter, colour, seed):
+    '''Fills out (n, 3, h, w) with the augmentations of a batch number.
+    Runs in the worker processes of augment_batches.'''
+    rng = np.random.RandomState([seed, batch])
+    x = np.empty(out.shape, dtype=np.float32)
+    for i, stem in enumerate(stems[batch * len(out):(batch + 1) * len(out)]):
+        im = _read_rgb(os.path.join(imdir, stem + '.png'))
+        ba.augment.crop_and_resize(im, [0, 0, im.shape[0], im.shape[1]],
+                                   out.shape[2:], out=x[i:i + 1])
+    augmented = augmenter(x, rng)
+    if colour:
+        augmented /= 255
+        ba.augment.hsv_jitter(augmented, rng)
+        augmented *= 255
+    out[...] = np.clip(np.rint(augmented), 0, 255)
+
+
+def sample_negatives(shape, boxes, count, rng=np.random, thresh=0.3,
+                     tries=29):
+    '''Samples negative boxes that barely overlap any positive box. Every
+    negative takes the size of a random positive box. All candidate
+    positions are drawn as one block and checked against all positive boxes
+    with one overlap matrix, the measure of ba.utils.slice_overlap.
+
+    Args:
+        shape (tuple): The shape (h, w) of the image
+        boxes (list): The positive bounding boxes as tuples of slices
+        count (int): How many negatives to sample
+        rng (np.random.RandomState, optional): The random generator
+        thresh (float, optional): The maximal overlap with a positive box
+        tries (int, optional): How many candidate positions per negative
+
+    Returns:
+        The indices in range(count) of the negatives that found a valid
+        position and their boxes (k, 4) as [y0, x0, y1, x1]
+    '''
+    starts = np.array([[b[0].start, b[1].start] for b in boxes])
+    sizes = np.array([[b[0].stop - b[0].start, b[1].stop - b[1].start]
+                      for b in boxes])
+    sizes = sizes[rng.randint(len(boxes), size=count)]
+    free = np.asarray(shape[:2]) - sizes
+    # (count, tries, 2)
+    coords = (rng.random_sample((count, tries, 2)) *
+              free[:, None]).astype(int)
+    # Intersections of the same sized boxes, (count, tries, boxes, 2)
+    inter = sizes[:, None, None] - np.abs(coords[:, :, None] - starts)
+    inter = np.maximum(inter, 0).prod(axis=3)
+    area = sizes.prod(axis=1)[:, None, None]
+    valid = (inter / (2 * area - inter)).max(axis=2) <= thresh
+    found = np.flatnonzero(valid.any(axis=1))
+    picked = coords[found, valid[found].argmax(axis=1)]
+    return found, np.hstack([picked, picked + sizes[found]])
+
+
+def negative_patches(im, boxes, count, shape=(224, 224), rng=np.random):
+    '''Samples negatives of an image and resizes them to one batch, e.g.
+    for a PatchBankWriter or an LMDBWriter.
+
+    Args:
+        im (ndarray): The image (h, w, c)
+        boxes (list): The positive bounding boxes as tuples of slices
+        count (int): How many negatives to sample
+        shape (tuple, optional): The shape (h, w) of the patches
+        rng (np.random.RandomState, optional): The random generator
+
+    Returns:
+        The float32 patches (k, c, h, w) and their boxes (k, 4)
+    '''
+    _, negatives = sample_negatives(im.shape, boxes, count, rng)
+    return ba.augment.crop_and_resize(im, negatives, shape), negatives
+
+
+def _generate_negatives(basepath, im, boxes, count, rng):
+    # Save neagtive patches
+    found, negatives = sample_negatives(im.shape, boxes, count, rng)
+    for i, (y0, x0, y1, x1) in zip(found, negatives):
+        imsave(basepath + '_{}.png'.format(i), im[y0:y1, x0:x1])
 
 
 class PascalPartSet(object):
@@ -18,7 +368,8 @@ class PascalPartSet(object):
     _testtrain = 0.2
 
     def __init__(self, name, root='.', parts=[], classes=[],
-                 dolists=True, defaulting=False):
+                 dolists=True, defaulting=False, use_index=True, processes=1,
+                 seed=0, incremental=False, masks='png'):
         '''Constructs a new PascalPartSet
 
         Args:
@@ -26,6 +377,18 @@ class PascalPartSet(object):
             root (str, optional): The path for the dir with the mat files
             parts (list, optional): The parts we are interested in
             classes (classes, optional): The classes we are interested in
+            use_index (bool, optional): Whether to read the annotations from
+                the compiled index instead of the mat files
+            processes (int, optional): The count of processes for the build
+                stages, the outputs do not depend on it
+            seed (int, optional): The base seed for the negative sampling,
+                every image derives its own seed from it
+            incremental (bool, optional): Whether to keep a build manifest
+                and only rebuild the outputs whose inputs changed
+            masks (str, optional): 'png' writes one file per mask, as the
+                experiment configs expect. 'archive' writes the segmentations
+                and the patch masks into one MaskArchive per directory
+                instead, see scripts/export_masks.py
         '''
         self.name = name
         self.source = root
@@ -35,9 +398,127 @@ class PascalPartSet(object):
         self.parts = parts
         self.partslist = None
         self.defaulting = defaulting
+        self.processes = processes
+        self.seed = seed
+        self.masks = masks
+        self.index = self.load_index() if use_index else None
+        self.manifest = None
+        if incremental:
+            self.manifest = Manifest(self.build + 'manifest.mp')
+        self._hashes = {}
         if dolists:
             self.generate_lists()
 
+    def load_index(self):
+        '''Opens the compiled annotation index of the source directory and
+        compiles it first if it is missing or outdated.
+
+        Returns:
+            The ba.archive.Archive
+        '''
+        path = '{}annotations_{}.archive'.format(
+            self._builddir, ba.cache.hash_bytes(os.path.abspath(self.source)))
+        files = sorted(glob(os.path.join(self.source, '*' + self.extension)))
+        if os.path.isfile(path):
+            index = ba.archive.Archive(path)
+            if index.meta.get('stamp') == _stamp(files):
+                return index
+            index.close()
+        return compile_index(self.source, path, self.extension)
+
+    def item(self, path):
+        '''Returns the PascalPart of a mat file path.'''
+        return PascalPart(path, index=self.index)
+
+    def _map(self, stage, rows, **conf):
+        '''Runs a build stage for every row, in a process pool if processes
+        is above 1. The stages are module level functions stage(row, conf).
+
+        Returns:
+            The results in the order of rows
+        '''
+        rows = list(rows)
+        conf['index'] = None if self.index is None else self.index.path
+        work = partial(stage, conf=conf)
+        # Daemonic processes, e.g. the workers of a pool, may not have
+        # children
+        if (self.processes == 1 or len(rows) < 2 or
+                mp.current_process().daemon):
+            return [work(row) for row in tqdm(rows)]
+        chunksize = max(1, min(32, len(rows) // (4 * self.processes)))
+        with mp.Pool(self.processes) as p:
+            return list(tqdm(p.imap(work, rows, chunksize=chunksize),
+                             total=len(rows)))
+
+    def _content_hashes(self, paths):
+        '''Returns the content hashes of files. Every file is hashed once
+        per set, in the process pool.'''
+        missing = sorted(set(paths) - set(self._hashes))
+        if len(missing) > 0:
+            self._hashes.update(zip(missing, self._map(_hash_stage, missing)))
+        return [self._hashes[path] for path in paths]
+
+    def _row_digests(self, rows, inputs, images=None):
+        '''Digests the content of every row, and of its image if given,
+        with the parameters its outputs depend on.
+
+        Args:
+            rows (list): The rows
+            inputs (tuple): The parameters the outputs depend on
+            images (list, optional): The paths of the images of the rows
+
+        Returns:
+            The digests in the order of rows, None without a manifest
+        '''
+        if self.manifest is None:
+            return None
+        hashes = self._content_hashes(rows)
+        if images is not None:
+            hashes = [Manifest.digest(h, im) for h, im in
+                      zip(hashes, self._content_hashes(images))]
+        return [Manifest.digest(h, inputs) for h in hashes]
+
+    def _incremental_map(self, stage, rows, artifact, digests, outputs=(),
+                         pack=None, unpack=None, **conf):
+        '''Like _map, but with a manifest the stage only runs for the stale
+        rows, see Manifest.stale. The other rows get their recorded results.
+
+        Args:
+            stage (callable): The stage, see _map. If it has outputs, its
+                results are tuples that end with the mask records of the row
+            rows (list): The rows
+            artifact (str): The name of the per row outputs in the manifest
+            digests (list): The digests of the rows, see _row_digests
+            outputs (list of str, optional): The output directories of the
+                stage
+            pack (callable, optional): Makes a result msgpack-able
+            unpack (callable, optional): Reverses pack
+            conf: Passed to the stage
+
+        Returns:
+            The results in the order of rows and a digest over the inputs
+            of all rows, None without a manifest
+        '''
+        rows = list(rows)
+        if self.manifest is None:
+            return self._map(stage, rows, **conf), None
+        prefix = '{}/{}/'.format(artifact, self.tag)
+        stems = [_stem(row) for row in rows]
+        stale = self.manifest.stale(prefix, stems, digests, outputs)
+        print('{} of {} {} are up to date'.format(
+            len(rows) - len(stale), len(rows), artifact))
+        results = dict(zip(stale, self._map(stage, [rows[i] for i in stale],
+                                            **conf)))
+        self.manifest.record_rows(prefix, stems, digests, {
+            i: (result if pack is None else pack(result),
+                result[-1] if len(outputs) > 0 else None)
+            for i, result in results.items()}, outputs)
+        for i, stem in enumerate(stems):
+            if i not in results:
+                value = self.manifest.result(prefix, stem)
+                results[i] = value if unpack is None else unpack(value)
+        return [results[i] for i in range(len(rows))], Manifest.digest(digests)
+
     @property
     def parts(self):
         return self.__parts
@@ -96,6 +577,31 @@ class PascalPartSet(object):
 
     def generate_lists(self):
         '''Generates the *.txt lists for this set.'''
+        regenerate = self._prepare_lists()
+        if regenerate is None:
+            return True
+
+        if regenerate:
+            rows = list(self.sourcelist)
+            results, _ = self._incremental_map(
+                _list_stage, rows, 'lists',
+                self._row_digests(rows, (self.classes, self.parts)),
+                unpack=tuple, classes=self.classes, parts=self.parts)
+            for row, (in_class, in_parts) in zip(rows, results):
+                if in_class:
+                    self.classlist.list.append(row)
+                if in_parts:
+                    self.partslist.list.append(row)
+        self.write('class')
+        self.write('parts')
+
+    def _prepare_lists(self):
+        '''Opens the lists and generates the source list if needed.
+
+        Returns:
+            Whether the class and parts lists have to be regenerated, they
+            are emptied then. None if no list has to be written at all.
+        '''
         f = {
             'source': self.build + self.name + '.txt',
             'class': self.build + '_'.join(self.classes) + '.txt',
@@ -115,7 +621,7 @@ class PascalPartSet(object):
                                                         self.extension)
 
         if not sum(overwrite.values()):
-            return True
+            return None
 
         if overwrite['source']:
             print('Generating List {}'.format(f['source']))
@@ -127,18 +633,8 @@ class PascalPartSet(object):
             self.classlist.list = []
             self.partslist.list = []
             print('Generating List {} and {}'.format(f['class'], f['parts']))
-            for row in tqdm(self.sourcelist):
-                item = PascalPart(row)
-                if len(set(self.classes) &
-                       item.classnames) > 0 or len(self.classes) < 1:
-                    self.classlist.list.append(row)
-                    # print(item.classnames)
-                    nrest = item.reduce(keep_parts=self.parts,
-                                        keep_classes=self.classes)
-                    if nrest > 0:
-                        self.partslist.list.append(row)
-        self.write('class')
-        self.write('parts')
+            return True
+        return False
 
     def segmentations(self, combine=True):
         '''Saves the segmentations for selected classes or parts.
@@ -146,34 +642,39 @@ class PascalPartSet(object):
         Args:
             combine (bool, optional): Whether to combine the parts.
         '''
+        targets = self._segmentation_targets()
+        if len(targets) == 0:
+            return True
+
+        print('Generating and extracting the segmentations for ' + self.tag)
+        rows = list(self.classlist)
+        results, _ = self._incremental_map(
+            _segmentation_stage, rows, 'segmentations',
+            self._row_digests(rows, (self.classes, self.parts, combine,
+                                     sorted(targets.items()), self.masks)),
+            outputs=list(targets.values()), pack=lambda result: None,
+            unpack=lambda value: (None, ), classes=self.classes,
+            parts=self.parts, combine=combine, targets=targets,
+            masks=self.masks)
+        for directory in targets.values():
+            self._write_masks(directory, [(_stem(row), records) for
+                                          row, (records, ) in zip(rows,
+                                                                  results)])
 
+    def _segmentation_targets(self):
+        '''Returns the segmentation directories per mode that are to be
+        (over)written.'''
         d = {
             'classes': '{}segmentations/{}/'.format(self.build,
                                                     '_'.join(self.classes)),
             'parts': '{}segmentations/{}/'.format(self.build, self.tag)
             }
-        overwrite = {
-            'classes': ba.utils.query_overwrite(d['classes'], default='yes',
-                                                defaulting=self.defaulting),
-            'parts': ba.utils.query_overwrite(d['parts'], default='yes',
-                                              defaulting=self.defaulting)
-            }
-        if not any(overwrite.values()):
-            return True
+        return {mode: d[mode] for mode in d
+                if ba.utils.query_overwrite(d[mode], default='yes',
+                                            defaulting=self.defaulting)}
 
-        print('Generating and extracting the segmentations for ' + self.tag)
-        for item in tqdm(self.classlist):
-            idx = os.path.splitext(os.path.basename(item))[0]
-            item = PascalPart(item)
-            item.reduce(self.parts, self.classes, combine)
-            if overwrite['parts']:
-                item.target = d['parts'] + idx
-                item.save(mode='parts')
-            if overwrite['classes']:
-                item.target = d['classes'] + idx
-                item.save(mode='class')
-
-    def bounding_boxes(self, imgdir, negatives=0, augment=0, combine=True):
+    def bounding_boxes(self, imgdir, negatives=0, augment=0, combine=True,
+                       colour=False):
         '''Saves the bounding box patches for classes and parts.
 
         Args:
@@ -181,6 +682,54 @@ class PascalPartSet(object):
             negatives (int, optional): How many negative samples to generate
             augment (int, optional): How many augmentations per image
             combine (bool, optional): Whether to combine the parts.
+            colour (bool, optional): Whether to jitter the colours of the
+                augmentations
+        '''
+        d = self._patch_dirs()
+        if d is not None:
+            ext = ba.utils.prevalent_extension(imgdir)
+            print('''Generating and extracting the segmentation bounding
+                  boxes for ''' + self.tag)
+            rows = list(self.classlist)
+            digests = self._row_digests(
+                rows, (self.classes, self.parts, combine, negatives,
+                       self.seed, self.masks),
+                images=['{}{}.{}'.format(imgdir, _stem(row), ext)
+                        for row in rows])
+            results, digest = self._incremental_map(
+                _bounding_box_stage, rows, 'patches', digests,
+                outputs=[d[key] for key in sorted(d) if key != 'base'],
+                pack=lambda result: _pack_boxes(result[:3]),
+                unpack=lambda value: _unpack_boxes(value) + (None, ),
+                classes=self.classes, parts=self.parts, combine=combine,
+                imgdir=imgdir, ext=ext, dirs=d, negatives=negatives,
+                seed=self.seed, masks=self.masks)
+            for directory in (d['class_seg'], d['patch_seg']):
+                self._write_masks(directory, [(idx, records) for idx, _, _,
+                                              records in results])
+            self._save_boxes(d, [result[:3] for result in results])
+            self._incremental_lmdb(d['base'], augment, colour, digest)
+
+    def _incremental_lmdb(self, base, augment, colour, digest):
+        '''Runs augment_and_lmdb unless the manifest shows that the patches
+        and augmentation parameters did not change.'''
+        if self.manifest is None:
+            return self.augment_and_lmdb(base, augment, colour)
+        key = 'lmdb/' + self.tag
+        digest = Manifest.digest(digest, augment, colour, self.seed)
+        if (self.manifest.fresh(key, digest) and
+                os.path.isdir(base + 'img_augmented_lmdb_train')):
+            print('LMDB of {} is up to date'.format(self.tag))
+            return
+        self.augment_and_lmdb(base, augment, colour)
+        self.manifest.record(key, digest)
+        self.manifest.save()
+
+    def _patch_dirs(self):
+        '''Creates the patch directories.
+
+        Returns:
+            The directories, None if the patches are not to be (over)written
         '''
         class_patches_base_dir = '{}patches/{}/'.format(
             self.build, '_'.join(self.classes))
@@ -188,6 +737,7 @@ class PascalPartSet(object):
             self.build, self.tag)
 
         d = {
+            'base': part_patches_base_dir,
             'patch_pos': ba.utils.touch(part_patches_base_dir + 'img/pos/'),
             'patch_neg': ba.utils.touch(part_patches_base_dir + 'img/neg/'),
             'patch_seg': ba.utils.touch(part_patches_base_dir + 'seg/'),
@@ -196,165 +746,391 @@ class PascalPartSet(object):
             }
         if ba.utils.query_overwrite(part_patches_base_dir, default='yes',
                                     defaulting=self.defaulting):
-            ext = ba.utils.prevalent_extension(imgdir)
+            return d
+        return None
 
-            class_db = {}
-            patch_db = {}
-            class_db_path = d['class_seg'][:-1] + '.yaml'
-            patch_db_path = d['patch_seg'][:-1] + '.yaml'
+    def _write_masks(self, directory, rows):
+        '''Writes the mask records of a directory into the MaskArchive next
+        to it, directory[:-1] + '.archive'.
 
-            print('''Generating and extracting the segmentation bounding
-                  boxes for ''' + self.tag)
-            for item in tqdm(self.classlist):
-                idx = os.path.splitext(os.path.basename(item))[0]
-                item = PascalPart(item)
-                im = imread(imgdir + idx + '.' + ext)
-                item.reduce(self.parts, self.classes, combine)
-                multpl_classes = len(self.classes) > 1
-
-                # Save Class patches
-                item.target = d['class_seg'] + idx
-                class_bound_boxes = item.bounding_box(mode='class')
-                item.target = d['patch_seg'] + idx
-                part_bound_boxes = item.bounding_box(mode='parts')
-                patch_bb_list = []
-                class_bb_list = []
-                for classname in self.classes:
-                    class_target = d['class_img'] + idx
-                    patch_target = d['patch_pos'] + idx
-                    if multpl_classes:
-                        class_target += '_' + classname
-                        patch_target += '_' + classname
-                    for it, bb in enumerate(class_bound_boxes[classname]):
-                        class_bb_list.append(bb)
-                        imsave(class_target + '_' + str(it) + '.png', im[bb])
-                    for it, bb in enumerate(part_bound_boxes[classname]):
-                        patch_bb_list.append(bb)
-                        imsave(patch_target + '_' + str(it) + '.png', im[bb])
-
-                if len(class_bb_list) > 0:
-                    class_db[idx] = class_bb_list
-                if len(patch_bb_list) > 0:
-                    patch_db[idx] = patch_bb_list
-                    self._generate_negatives(d['patch_neg'] + idx, im,
-                                             patch_bb_list, negatives)
-
-            ba.utils.save(class_db_path, class_db)
-            ba.utils.save(patch_db_path, patch_db)
-            self.augment_and_lmdb(part_patches_base_dir, augment)
-
-    def augment_and_lmdb(self, part_patches_base_dir, augment):
+        Args:
+            directory (str): The output directory
+            rows (iterable): (image id, records) pairs in list order, records
+                of None mark rows that are up to date in the manifest, they
+                keep their record of the previous archive.
+        '''
+        if self.masks != 'archive':
+            return
+        path = directory[:-1] + '.archive'
+        old = MaskArchive(path) if os.path.isfile(path) else None
+        with MaskArchiveWriter(path) as writer:
+            for idx, records in rows:
+                if records is None:
+                    if old is not None and idx in old:
+                        writer.put(idx, old.record(idx))
+                elif directory in records:
+                    writer.put(idx, records[directory])
+        if old is not None:
+            old.close()
+
+    def _save_boxes(self, d, results):
+        '''Merges the bounding boxes of all images in list order and saves
+        them next to the seg directories.
+
+        Args:
+            d (dict): The patch directories, see _patch_dirs
+            results (list): Tuples of the image name and its lists of class
+                and part bounding boxes
+        '''
+        class_db = {}
+        patch_db = {}
+        for idx, class_bb_list, patch_bb_list in results:
+            if len(class_bb_list) > 0:
+                class_db[idx] = class_bb_list
+            if len(patch_bb_list) > 0:
+                patch_db[idx] = patch_bb_list
+        ba.utils.save(d['class_seg'][:-1] + '.yaml', class_db)
+        ba.utils.save(d['patch_seg'][:-1] + '.yaml', patch_db)
+
+    def augment_and_lmdb(self, part_patches_base_dir, augment, colour=False,
+                         save_png=False):
+        '''Augments the positive and negative patches and writes them straight
+        into the train and test LMDB.
+
+        Args:
+            part_patches_base_dir (str): The patch directory of the parts
+            augment (int): How many augmentations per image
+            colour (bool, optional): Whether to jitter the colours in HSV
+            save_png (bool, optional): Whether to also save the augmentations
+                as png files
+        '''
         if ba.utils.query_overwrite(part_patches_base_dir + 'img_augmented/',
                                     default='yes', defaulting=self.defaulting):
             naugment = len(self.classlist) * augment
-            self.augment_single(part_patches_base_dir + 'img/pos/', naugment)
-            self.augment_single(part_patches_base_dir + 'img/neg/', naugment)
-            self.generate_LMDB(part_patches_base_dir + 'img_augmented/')
-
-    def _generate_negatives(self, basepath, im, boxes, count):
-        def overlaps(coords, shape):
-            return [ba.utils.slice_overlap((b[0].start, b[1].start),
-                                           coords, shape) for b in boxes]
-
-        # Save neagtive patches
-        for i in range(count):
-            box = random.choice(boxes)
-            neg_coords = (box[0].start, box[1].start)
-            shape = (box[0].stop - box[0].start,
-                     box[1].stop - box[1].start)
-            subim = [im.shape[0] - shape[0],
-                     im.shape[1] - shape[1]]
-            checkidx = 0
-            while checkidx < 30 and max(overlaps(neg_coords, shape)) > 0.3:
-                checkidx += 1
-                neg_coords = (np.random.random(2) * subim).astype(int)
-            if checkidx >= 30:
-                continue
-            negative_patch = im[neg_coords[0]:neg_coords[0] + shape[0],
-                                neg_coords[1]:neg_coords[1] + shape[1]]
-            imsave(basepath + '_{}.png'.format(i), negative_patch)
+            streams = {
+                label: self.augment_batches(
+                    part_patches_base_dir + 'img/' + sub + '/', naugment,
+                    colour)
+                for sub, label in (('pos', 1), ('neg', 0))}
+            self.generate_LMDB(part_patches_base_dir + 'img_augmented/',
+                               streams, save_png)
 
-    def generate_LMDB(self, path):
-        '''Generates the LMDB for the trainingset.
+    def generate_LMDB(self, path, streams=None, save_png=False, wh=224):
+        '''Generates the train and test LMDB for the trainingset in process.
+        The first 20 % of the sorted names of both labels go into the test
+        set, the records of each set are read in shuffled order.
 
         Args:
             path (str): The path to the image directory. (Contains dirs pos and
                        neg)
+            streams (dict, optional): Per label 1 and 0 the names and the
+                batches as returned by augment_batches. If not given the
+                images in the pos and neg dirs of path are read and resized.
+            save_png (bool, optional): Whether to save the streamed batches
+                into path
+            wh (int, optional): The size of the read images
         '''
+        from ba.lmdbwriter import LMDBWriter
         print('Generating LMDB for {}'.format(path))
         absp = os.path.abspath(path)
         target = {'train': absp + '_lmdb_train', 'test': absp + '_lmdb_test'}
         for d in target.values():
             ba.utils.rm(d)
             ba.utils.rm(d + '.txt')
-        wh = 224
-        trainlist = SetList(absp + '/pos/')
-        trainlist.add_pre_suffix(absp + '/pos/', '.png 1')
-        negList = SetList(absp + '/neg/')
-        negList.add_pre_suffix(absp + '/neg/', '.png 0')
-        n = {'pos': int(len(trainlist) * 0.2), 'neg': int(len(negList) * 0.2)}
-        testlist = copy.deepcopy(trainlist)
-        testlist.list = testlist.list[:n['pos']] + negList.list[:n['neg']]
-        trainlist.list = trainlist.list[n['pos']:] + negList.list[n['neg']:]
-        trainlist.target = target['train'] + '.txt'
-        testlist.target = target['test'] + '.txt'
-        trainlist.write()
-        testlist.write()
-        cmdstr = 'convert_imageset --resize_height={} '
-        cmdstr += '--resize_height={} --shuffle "/"'
-        cmdstr = cmdstr.format(wh, wh)
-        os.system('{} "{}" "{}" '.format(cmdstr, trainlist.target,
-                                         target['train']))
-        os.system('{} "{}" "{}" '.format(cmdstr, testlist.target,
-                                         target['test']))
-
-    def augment_single(self, imdir, n):
-        '''Generates augmentet images
+        subdirs = {1: 'pos', 0: 'neg'}
+        if streams is None:
+            streams = {label: self._read_batches(absp + '/' + sub + '/', wh)
+                       for label, sub in subdirs.items()}
+            save_png = False
+
+        rows = {'train': [], 'test': []}
+        split = {}
+        for label in (1, 0):
+            names = sorted(streams[label][0])
+            n = int(len(names) * self._testtrain)
+            rows['test'] += [(name, label) for name in names[:n]]
+            rows['train'] += [(name, label) for name in names[n:]]
+        # The record keys give the read order, like convert_imageset --shuffle
+        for mode, modrows in rows.items():
+            for rank, (name, label) in zip(
+                    np.random.RandomState(self.seed).permutation(
+                        len(modrows)), modrows):
+                split[(label, name)] = (mode, '{:08d}_{}/{}.png'.format(
+                    rank, subdirs[label], name))
+
+        writers = {mode: LMDBWriter(target[mode]) for mode in target}
+        try:
+            for label in (1, 0):
+                names, batches = streams[label]
+                if save_png:
+                    ba.utils.rm(absp + '/' + subdirs[label])
+                    os.makedirs(absp + '/' + subdirs[label])
+                for batch_names, batch in batches:
+                    for name, im in zip(batch_names, batch):
+                        if save_png:
+                            imsave('{}/{}/{}.png'.format(
+                                absp, subdirs[label], name),
+                                im.transpose((1, 2, 0)))
+                        mode, key = split[(label, name)]
+                        # BGR like the images read by caffe
+                        writers[mode].put(key, im[::-1], label)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        # The lists also point the experiments to the LMDBs
+        for mode, modrows in rows.items():
+            setlist = SetList()
+            setlist.list = ['{}/{}/{}.png {}'.format(
+                absp, subdirs[label], name, label)
+                for name, label in modrows]
+            setlist.target = target[mode] + '.txt'
+            setlist.write()
+
+    def _read_batches(self, imdir, wh, batch_size=50):
+        '''Reads and resizes all png images of a directory.
+
+        Returns:
+            The names and a generator of (names, uint8 batch (n, 3, wh, wh))
+        '''
+        names = sorted(os.path.splitext(f)[0] for f in os.listdir(imdir)
+                       if f.endswith('.png'))
+
+        def batches():
+            batch = np.empty((batch_size, 3, wh, wh), dtype=np.float32)
+            for start in range(0, len(names), batch_size):
+                batch_names = names[start:start + batch_size]
+                for i, name in enumerate(batch_names):
+                    im = _read_rgb(os.path.join(imdir, name + '.png'))
+                    ba.augment.crop_and_resize(
+                        im, [0, 0, im.shape[0], im.shape[1]], (wh, wh),
+                        out=batch[i:i + 1])
+                yield batch_names, np.clip(np.rint(batch[:len(batch_names)]),
+                                           0, 255).astype(np.uint8)
+        return names, batches()
+
+    def augment_batches(self, imdir, n, colour=False, shape=(224, 224),
+                        batch_size=50):
+        '''Generates augmented images in memory, in worker processes if
+        processes is above 1. Every batch draws from a generator seeded by
+        the seed of the set, the directory name and its number, so the
+        augmentations do not depend on the count of processes.
+
+        Args:
+            imdir (str): The path to the images
+            n (int): Number of images to produce, rounded down to a multiple
+                of batch_size
+            colour (bool, optional): Whether to jitter the colours in HSV
+            shape (tuple, optional): The size of the augmented images
+            batch_size (int, optional): How many images to warp at once
+
+        Returns:
+            The names of all augmentations and a generator of
+            (names, uint8 batch (n, 3, h, w)) in RGB
+        '''
+        stems = sorted(os.path.splitext(f)[0] for f in os.listdir(imdir)
+                       if f.endswith('.png'))
+        nbatches = int(n / batch_size)
+        if len(stems) == 0 or nbatches == 0:
+            return [], iter([])
+        seed = _image_seed(os.path.basename(os.path.normpath(imdir)),
+                           self.seed)
+        rng = np.random.RandomState(seed)
+        order = np.concatenate([
+            rng.permutation(len(stems))
+            for _ in range(-(-nbatches * batch_size // len(stems)))])
+        order = order[:nbatches * batch_size].reshape(nbatches, batch_size)
+        names = ['{}_{}'.format(stems[nameidx], i)
+                 for i, nameidx in enumerate(order.flat)]
+        produce = partial(_augment_batch, imdir=imdir,
+                          stems=[stems[k] for k in order.flat],
+                          augmenter=ba.augment.Augmenter(), colour=colour,
+                          seed=seed)
+        batch_shape = (batch_size, 3) + tuple(shape)
+
+        def batches():
+            if self.processes == 1:
+                for batch in range(nbatches):
+                    out = np.empty(batch_shape, dtype=np.uint8)
+                    produce(out, batch)
+                    yield names[batch * batch_size:(batch + 1) *
+                                batch_size], out
+                return
+            pool = SharedBatchPool(
+                lambda arrays, rng, batch: (
+                    produce(arrays[0], batch) if batch < nbatches else None),
+                [batch_shape], [np.uint8], workers=self.processes,
+                numbered=True)
+            try:
+                for batch in range(nbatches):
+                    (out, ), _ = pool.next()
+                    yield names[batch * batch_size:(batch + 1) *
+                                batch_size], out
+            finally:
+                pool.close()
+        return names, batches()
+
+    def augment_single(self, imdir, n, colour=False, shape=(224, 224),
+                       batch_size=50):
+        '''Generates augmentet images and saves them as png files into a
+        sibling directory of imdir with the suffix _augmented.
 
         Args:
             imdir (str): The path to the images
             n (int): Number of images to produce
+            colour (bool, optional): Whether to jitter the colours in HSV
+            shape (tuple, optional): The size of the augmented images
+            batch_size (int, optional): How many images to warp at once
         '''
-        import keras.preprocessing.image
-        augmenter = keras.preprocessing.image.ImageDataGenerator(
-            rotation_range=15,
-            shear_range=0.2,
-            zoom_range=0.2,
-            width_shift_range=0.05,
-            height_shift_range=0.05,
-            horizontal_flip=True
-            )
         par_imdir = '/'.join(os.path.normpath(imdir).split('/')[:-1])
         bn_imdir = os.path.normpath(imdir).split('/')[-1]
         save_imdir = os.path.normpath(par_imdir) + '_augmented'
-        ba.utils.rm(save_imdir + '/' + bn_imdir)
-        os.makedirs(save_imdir + '/' + bn_imdir)
-        img_generator = augmenter.flow_from_directory(
-            directory=par_imdir,
-            target_size=(224, 224),
-            class_mode='binary',
-            classes=[bn_imdir],
-            save_to_dir=save_imdir + '/' + bn_imdir,
-            save_format='png',
-            batch_size=50
-            )
-        for _ in range(0, int(n / 50)):
-            img_generator.next()
+        save_dir = save_imdir + '/' + bn_imdir
+        ba.utils.rm(save_dir)
+        os.makedirs(save_dir)
+        _, batches = self.augment_batches(imdir, n, colour, shape,
+                                          batch_size)
+        for names, augmented in batches:
+            for name, im in zip(names, augmented):
+                imsave('{}/{}.png'.format(save_dir, name),
+                       im.transpose((1, 2, 0)))
+
+
+def build_queries(sets, imgdir, negatives=0, augment=0, combine=True,
+                  colour=False):
+    '''Builds the lists, segmentations and patches of several
+    PascalPartSets on the same annotations in a single pass. Every annotation
+    and image is read once and handed to all sets, the outputs are the same
+    as running generate_lists, segmentations and bounding_boxes per set.
+
+    Args:
+        sets (list of PascalPartSet): The sets, constructed with
+            dolists=False. The first one sets the processes.
+        imgdir (str): The directory where the original images live
+        negatives (int, optional): How many negative samples to generate
+        augment (int, optional): How many augmentations per image
+        combine (bool, optional): Whether to combine the parts.
+        colour (bool, optional): Whether to jitter the colours of the
+            augmentations
+    '''
+    queries = []
+    for ppset in sets:
+        regenerate = ppset._prepare_lists()
+        dirs = ppset._patch_dirs()
+        queries.append({
+            'classes': ppset.classes,
+            'parts': ppset.parts,
+            'members': None if regenerate else set(ppset.classlist),
+            'targets': ppset._segmentation_targets(),
+            'dirs': dirs,
+            'negatives': negatives,
+            'seed': ppset.seed
+            })
+    rows = list(sets[0].sourcelist)
+    ext = ba.utils.prevalent_extension(imgdir)
+    stems = [_stem(row) for row in rows]
+    images = ['{}{}.{}'.format(imgdir, stem, ext) for stem in stems]
+    # Per query the output directories, the manifest keys and digests of the
+    # rows and the rows to rebuild
+    outputs = []
+    prefixes = []
+    digests = []
+    stale = []
+    for ppset, query in zip(sets, queries):
+        outputs.append(list(query['targets'].values()))
+        if query['dirs'] is not None:
+            outputs[-1] += [query['dirs'][key] for key in
+                            sorted(query['dirs']) if key != 'base']
+        prefixes.append('queries/{}/'.format(ppset.tag))
+        # The sets share the annotations, every file is hashed once
+        ppset._hashes = sets[0]._hashes
+        digests.append(ppset._row_digests(
+            rows, (query['classes'], query['parts'], combine, negatives,
+                   query['seed'], sorted(query['targets'].items()),
+                   query['dirs'] is not None, query['members'] is None,
+                   ppset.masks), images))
+        if ppset.manifest is None:
+            stale.append(set(range(len(rows))))
+        else:
+            stale.append(set(ppset.manifest.stale(prefixes[-1], stems,
+                                                  digests[-1], outputs[-1])))
+    work = []
+    for i, row in enumerate(rows):
+        active = [q for q in range(len(sets)) if i in stale[q]]
+        if len(active) > 0:
+            work.append((i, (row, active)))
+    print('Generating the lists, segmentations and bounding boxes for ' +
+          ', '.join(ppset.tag for ppset in sets))
+    print('{} of {} images are up to date'.format(
+        len(rows) - len(work), len(rows)))
+    computed = dict(zip([i for i, _ in work], sets[0]._map(
+        _query_stage, [w for _, w in work], queries=queries,
+        combine=combine, imgdir=imgdir, ext=ext, masks=sets[0].masks)))
+    for q, (ppset, query) in enumerate(zip(sets, queries)):
+        built = {i: computed[i] for i in stale[q]}
+        if ppset.manifest is not None:
+            ppset.manifest.record_rows(prefixes[q], stems, digests[q], {
+                i: (_pack_boxes(result[1][q]), result[2])
+                for i, result in built.items()}, outputs[q])
+        per_row = []
+        for i, row in enumerate(rows):
+            if i in built:
+                res = built[i][1][q]
+            else:
+                res = _unpack_boxes(ppset.manifest.result(prefixes[q],
+                                                          stems[i]))
+            per_row.append((row, stems[i], res))
+        records = [built[i][2] if i in built else None
+                   for i in range(len(rows))]
+        directories = list(query['targets'].values())
+        if query['dirs'] is not None:
+            directories += [query['dirs']['class_seg'],
+                            query['dirs']['patch_seg']]
+        for directory in directories:
+            ppset._write_masks(directory, zip(stems, records))
+        if query['members'] is None:
+            for row, _, (in_class, in_parts, _, _) in per_row:
+                if in_class:
+                    ppset.classlist.list.append(row)
+                if in_parts:
+                    ppset.partslist.list.append(row)
+            ppset.write('class')
+            ppset.write('parts')
+        if query['dirs'] is not None:
+            ppset._save_boxes(query['dirs'], [
+                (idx, class_bbs, patch_bbs)
+                for _, idx, (in_class, _, class_bbs, patch_bbs) in per_row
+                if in_class])
+            ppset._incremental_lmdb(
+                query['dirs']['base'], augment, colour,
+                None if digests[q] is None else Manifest.digest(digests[q]))
 
 
 class PascalPart(object):
-    def __init__(self, source=''):
+    '''The annotation of one image. Only the structure (class and part
+    names) is read eagerly. Masks stay in their stored form, packed index
+    records or the raw arrays of the mat file, until save or bounding_box
+    needs them, and the unions are only built then.'''
+
+    def __init__(self, source='', index=None):
         '''Constructs a new PascalPart.
 
         Args:
             source (str, optional): The path to mat file
+            index (ba.archive.Archive, optional): A compiled annotation index,
+                see compile_index. Used instead of the mat file if it holds
+                the annotation.
         '''
-        self.parts = {}
+        self.index = index
         self.itemsave = lambda path, im: imsave(path + '.png', im)
+        # Collects the masks per directory instead of saving png files
+        self.records = None
         self.classnames = set()
+        self.shape = None
         self.segmentations = collections.defaultdict(list)
         self.parts = collections.defaultdict(list)
-        self.unions = collections.defaultdict(list)
+        self.combine = True
+        self._unions = None
         self.target = source
         self.source = source
 
@@ -368,7 +1144,10 @@ class PascalPart(object):
         self.load()
 
     def load(self):
-        '''Loads the inouts from the mat file'''
+        '''Loads the inouts from the index or the mat file'''
+        key = os.path.splitext(os.path.basename(self.source))[0]
+        if self.index is not None and key in self.index:
+            return self._load_record(self.index[key])
         mat = sio.loadmat(self.source)
         try:
             mat = mat['anno'][0][0][1][0]
@@ -377,19 +1156,73 @@ class PascalPart(object):
             return False
         for submat in mat:
             classname, segmentation, parts = self._load_object(submat)
+            self.shape = segmentation.shape
             self.classnames.add(classname)
             self.parts[classname].append(parts)
             self.segmentations[classname].append(segmentation)
 
-    def _load_object(self, submat):
+    def _load_record(self, record):
+        self.shape = tuple(record['shape'])
+        for obj in record['objects']:
+            classname = obj['class']
+            self.classnames.add(classname)
+            self.parts[classname].append(dict(obj['parts']))
+            self.segmentations[classname].append(obj['mask'])
+
+    @staticmethod
+    def _load_object(submat):
         classname = submat[0][0]
-        segmentation = submat[2].astype('float')
+        segmentation = submat[2]
         parts = {}
         if submat[3].size and submat[3][0].size:
             for part in submat[3][0]:
-                parts[part[0][0]] = part[1].astype('float')
+                parts[part[0][0]] = part[1]
         return classname, segmentation, parts
 
+    def mask(self, source):
+        '''Materializes a stored mask (packed record or raw array).'''
+        if isinstance(source, Mask):
+            return source
+        if isinstance(source, dict):
+            return Mask.unpack(source, self.shape)
+        return Mask.from_dense(source)
+
+    def _bbox(self, source):
+        '''Returns the bounding box of a stored mask as tuple of slices or
+        None, without decoding packed records.'''
+        if isinstance(source, dict):
+            y0, x0, y1, x1 = source['bbox']
+            if y1 <= y0:
+                return None
+            return (slice(y0, y1), slice(x0, x1))
+        return self.mask(source).bbox()
+
+    @property
+    def unions(self):
+        '''The union masks per class, built on first access.'''
+        if self._unions is None:
+            self._unions = collections.defaultdict(list)
+            for classname, groups in self._union_sources().items():
+                self._unions[classname] = [
+                    Mask.union_of(self.mask(s) for s in group)
+                    for group in groups]
+        return self._unions
+
+    def _union_sources(self):
+        '''Returns per class the groups of stored part masks that form the
+        unions.'''
+        groups = collections.defaultdict(list)
+        for classname in self.classnames:
+            for parts_dict in self.parts[classname]:
+                if len(parts_dict) == 0:
+                    continue
+                if self.combine:
+                    groups[classname].append(list(parts_dict.values()))
+                else:
+                    groups[classname].extend(
+                        [part] for part in parts_dict.values())
+        return groups
+
     def save(self, mode='parts'):
         '''Saves the segmentations binarly same-sized to input
 
@@ -397,7 +1230,8 @@ class PascalPart(object):
             mode (str, optional): 'parts' or 'class'
         '''
         if mode == 'class':
-            sources = self.segmentations
+            sources = {c: [self.mask(s) for s in self.segmentations[c]]
+                       for c in self.classnames}
         else:
             sources = self.unions
         target = self.target
@@ -406,37 +1240,68 @@ class PascalPart(object):
                 target = self.target + '_' + classname
             if len(sources[classname]) == 0:
                 continue
-            sum_source = sources[classname][0] * 0
-            for source in sources[classname]:
-                sum_source += source
-            self.itemsave(target, sum_source.astype(bool))
+            self._emit(target, sources[classname], crop=False)
 
-    def bounding_box(self, mode='parts'):
+    def bounding_box(self, mode='parts', save=True):
         '''Saves the segmentations in their respective patches (bounding boxes)
 
         Args:
             mode (str, optional): Either doing the whole object or only the
                                   parts
+            save (bool, optional): Whether to save the patches, else only the
+                                   boxes are computed
 
         Returns:
             The bounding box slice for that patch
         '''
         target = self.target
         bbs = collections.defaultdict(list)
-        if mode == 'class':
-            sources = self.segmentations
-        else:
-            sources = self.unions
+        union_sources = self._union_sources()
         for classname in self.classnames:
             if len(self.classnames) > 1:
                 target = self.target + '_' + classname
-            if len(sources[classname]) > 0:
-                for it, source in enumerate(sources[classname]):
-                    patch, bb = self._singularize(source.astype(int))
-                    self.itemsave(target + '_' + str(it), patch)
-                    bbs[classname].append(bb)
+            if mode == 'class':
+                groups = [[s] for s in self.segmentations[classname]]
+            else:
+                groups = union_sources[classname]
+            if save:
+                masks = [Mask.union_of(self.mask(s) for s in group)
+                         for group in groups]
+                self._emit(target, masks, crop=True)
+                boxes = [mask.bbox() for mask in masks]
+            else:
+                boxes = [_hull([self._bbox(s) for s in group])
+                         for group in groups]
+            bbs[classname].extend(bb for bb in boxes if bb is not None)
         return bbs
 
+    def _emit(self, target, masks, crop):
+        '''Saves masks as png files or, if records is a dict, adds them to
+        the record of their directory, see MaskArchiveWriter.
+
+        Args:
+            target (str): The path of the files without extension
+            masks (list of Mask): The masks
+            crop (bool): Whether every mask is saved cropped to its bounding
+                box as target_<number>, else their union is saved as target
+        '''
+        if self.records is not None:
+            directory, name = os.path.split(target)
+            record = self.records.setdefault(directory + '/', {
+                'shape': list(self.shape), 'crop': crop, 'objects': []})
+            # Reduced copies share the records, queries writing the same
+            # directory must not add the objects of a row twice
+            if any(other == name for other, _ in record['objects']):
+                return
+            record['objects'].extend([name, mask.pack()] for mask in masks)
+        elif crop:
+            for it, mask in enumerate(masks):
+                patch, bb = self._singularize(mask)
+                if bb is not None:
+                    self.itemsave(target + '_' + str(it), patch)
+        else:
+            self.itemsave(target, Mask.union_of(masks).dense())
+
     def reduce(self, keep_parts=[], keep_classes=None, combine=True):
         '''Removes all object and all parts that are not given as keep..
 
@@ -457,7 +1322,6 @@ class PascalPart(object):
             # Iterate over their parts
             for parts_dict in self.parts[classname]:
                 new_parts_dict = {}
-                # print(parts_dict.keys())
                 for partname in parts_dict.keys():
                     if partname.split('_')[0] in keep_parts:
                         new_parts_dict[partname] = parts_dict[partname]
@@ -468,38 +1332,49 @@ class PascalPart(object):
         self.unionize(combine=combine)
         return nrest
 
+    def reduced(self, keep_parts=[], keep_classes=None, combine=True):
+        '''Like reduce, but on a copy. The stored masks are shared, this
+        PascalPart stays untouched.
+
+        Returns:
+            The reduced copy and the count of remaining parts
+        '''
+        item = copy.copy(self)
+        item.classnames = set(self.classnames)
+        nrest = item.reduce(keep_parts, keep_classes, combine)
+        return item, nrest
+
     def unionize(self, combine=True):
-        '''Generate the sum of the parts or the union of segmentations.
+        '''Sets how the unions of the parts are formed. They are computed on
+        first use.
         Args:
             combine (bool, optional): Whether to combine the parts.
         '''
-        self.unions = collections.defaultdict(list)
-        for classname in self.classnames:
-            for parts_dict in self.parts[classname]:
-                if len(parts_dict) == 0:
-                    continue
-                union = self.segmentations[classname][0] * 0
-                if combine:
-                    for part in parts_dict.values():
-                        union += part.astype(int)
-                    union = union.astype(bool)
-                    self.unions[classname].append(union)
-                else:
-                    for part in parts_dict.values():
-                        union = part.astype(bool)
-                        self.unions[classname].append(union)
+        self.combine = combine
+        self._unions = None
 
-    def _singularize(self, img):
-        '''Produces the cut part and bounding box slice for a single connected
-        component in an image
+    def _singularize(self, mask):
+        '''Produces the cut part and bounding box slice of a mask
 
         Args:
-            img (image): The image to search in
+            mask (Mask): The mask to search in
 
         Returns:
-            The part of the input image and the slice it fits.
+            The part of the mask as int image and the slice it fits, or
+            (None, None) for an empty mask.
         '''
-        slices = scipy.ndimage.find_objects(img)
-        # No idead why we need this:
-        bb = slices[-1]
-        return img[bb], bb
+        bb = mask.bbox()
+        if bb is None:
+            return None, None
+        return mask.dense(int)[bb], bb
+
+
+def _hull(bbs):
+    '''Returns the bounding box around a list of boxes, ignoring None.'''
+    bbs = [bb for bb in bbs if bb is not None]
+    if len(bbs) == 0:
+        return None
+    return (slice(min(bb[0].start for bb in bbs),
+                  max(bb[0].stop for bb in bbs)),
+            slice(min(bb[1].start for bb in bbs),
+                  max(bb[1].stop for bb in bbs)))
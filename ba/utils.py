@@ -1,4 +1,8 @@
 from ba import BA_ROOT
+import ba.augment
+import ba.bank
+import ba.workers
+import hashlib
 from itertools import zip_longest
 from glob import glob
 import msgpack
@@ -6,12 +10,7 @@ import os.path
 import sys
 import threading
 import yaml
-from itertools import count
 import numpy as np
-import skimage.transform as tf
-import scipy.misc
-import skimage.color
-from threading import Thread
 import random
 
 sys.path.append(BA_ROOT + '../telenotify')
@@ -344,29 +343,104 @@ def bounding_box_shape(bb):
             bb[1].stop - bb[1].start)
 
 
+def evict_banks(bankdir, maxbytes, keep=(), fraction=0.9):
+    '''Removes the least recently used PatchBanks of bankdir until it is at
+    fraction of maxbytes, like ba.cache.InferenceCache.evict. The banks in
+    keep are marked as used and never removed.
+
+    Args:
+        bankdir (str): The directory of the banks
+        maxbytes (int): The size bound of the directory
+        keep (list of str, optional): The paths of the banks in use
+        fraction (float, optional): The fill level to evict down to
+
+    Returns:
+        The count of removed banks
+    '''
+    keep = set(os.path.normpath(path) for path in keep)
+    for path in keep:
+        for ext in ('.npy', '.mp'):
+            if os.path.isfile(path + ext):
+                os.utime(path + ext)
+    banks = {}
+    for path in glob(os.path.join(bankdir, '*.npy')) + \
+            glob(os.path.join(bankdir, '*.mp')):
+        if path.endswith('.tmp.npy'):
+            # A bank still being written by another run
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        bank = banks.setdefault(os.path.normpath(os.path.splitext(path)[0]),
+                                [0, 0])
+        bank[0] = max(bank[0], stat.st_mtime)
+        bank[1] += stat.st_size
+    size = sum(bank[1] for bank in banks.values())
+    removed = 0
+    for mtime, nbytes, path in sorted((b[0], b[1], p)
+                                      for p, b in banks.items()):
+        if size <= fraction * maxbytes:
+            break
+        if path in keep:
+            continue
+        for ext in ('.npy', '.mp'):
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+        size -= nbytes
+        removed += 1
+    return removed
+
+
 class SamplesGenerator(object):
     def __init__(self, slicefiles, imlist, images_path, negatives_path,
                  ppI=None, patch_size=(100, 100), ext='jpg', mean=0,
-                 batch_size=10):
-        '''
+                 batch_size=10, workers=2, depth=4, seed=None,
+                 bankdir=BA_ROOT + 'data/tmp/samplebanks/', start=True,
+                 maxbytes=50 * 2**30):
+        '''The positive patches are sampled once per bank and kept on disk, so
+        their random jitter is frozen per bank: every run on the same slices,
+        images, ppI and patch size trains on the same positive crops, only the
+        augmentation and the drawn negatives change between runs.
+
         Args:
             slicefiles (str or list of str)
             imlist (list of str)
             images_path (str)
-            negatives_path (str)
+            negatives_path (str): A directory of negative pngs or the path
+                of a negative PatchBank, see ba.bank.build_negative_bank
             ppI (int, optionale)
             patch_size (tupel, optional)
             ext (str, optional)
             mean (ndarray, optional)
+            batch_size (int, optional)
+            workers (int, optional): The count of augmenting processes
+            depth (int, optional): The count of batches buffered ahead
+            seed (int, optional): The base seed of the augmenting processes
+            bankdir (str, optional): Where the uint8 sample banks are kept
+            start (bool, optional): Whether to start the own workers, else
+                the owner runs _produce in its workers
+            maxbytes (int, optional): The size bound of bankdir, the least
+                recently used banks are removed above it
         '''
         self.patch_size = patch_size
         self.mean = mean
         if isinstance(self.mean, np.ndarray) and self.mean.ndim == 3:
             self.mean = self.mean.transpose((2, 0, 1))
+        elif isinstance(self.mean, np.ndarray) and self.mean.ndim == 1:
+            self.mean = self.mean.reshape((-1, 1, 1))
         self.imlist = imlist
         self.ppI = ppI
         self.batch_size = batch_size
         self.negatives_path = negatives_path
+        self.workers = workers
+        self.depth = depth
+        self.seed = seed
+        self.augmenter = ba.augment.Augmenter()
+        self._order = []
+        self._pos = 0
 
         if not isinstance(slicefiles, list):
             slicefiles = [slicefiles]
@@ -390,92 +464,131 @@ class SamplesGenerator(object):
         if self.ppI % 2 != 0:
             raise ValueError('Count in SingleImageLayer is not divisble by 2.')
 
-        self.samples = np.zeros((n * self.ppI * 2, 3,
-                                 patch_size[0], patch_size[1]))
+        self.labels = np.append(np.ones(n * self.ppI), np.zeros(n * self.ppI))
+        self.npos = n * self.ppI
+        key = hashlib.sha1(repr((
+            [sorted(d.items()) for d in list_of_slice_dicts], images_path,
+            ext, self.ppI, tuple(patch_size))).encode())
+        bankpath = bankdir + key.hexdigest()
+        if not ba.bank.PatchBank.exists(bankpath):
+            self.gen_bank(bankpath, list_of_slice_dicts, n, images_path, ext)
+        self.samples = ba.bank.PatchBank(bankpath)
+        self.negatives = self.load_negatives(negatives_path, bankdir)
+        self.gen_negs(n)
+        evict_banks(bankdir, maxbytes, keep=[bankpath, self.negatives.path])
+        if start:
+            self.start_workers()
+
+    def gen_bank(self, bankpath, list_of_slice_dicts, n, images_path, ext):
+        '''Samples the positive patches into a uint8 bank.'''
+        writer = ba.bank.PatchBankWriter(
+            bankpath, n * self.ppI, (3, ) + tuple(self.patch_size))
         it = 0
         for slice_dict in list_of_slice_dicts:
             for path, bblist in slice_dict.items():
                 im = self.imread('{}{}.{}'.format(images_path, path, ext))
-                for bb in bblist:
+                samples = self.sample_image(im, bblist)
+                for bbsamples in samples:
                     subslice = slice(it, n * self.ppI, n)
-                    self.samples[subslice, ...] = self.sample_image(im, bb)
+                    writer[subslice] = bbsamples
                     it += 1
-        self.labels = np.append(np.ones(n * self.ppI), np.zeros(n * self.ppI))
-        self.gen_negs(n)
-        self.gen_flow()
-        self.reset_threads()
+        writer.close()
+
+    def load_negatives(self, negatives_path, bankdir):
+        '''Opens the negative bank. A directory of pngs is converted into a
+        bank of the patch size once and shared by all later runs.'''
+        if ba.bank.PatchBank.exists(negatives_path):
+            bank = ba.bank.PatchBank(negatives_path)
+            if bank.shape[1:] != tuple(self.patch_size):
+                raise ValueError('The negative bank {} holds {} patches, not '
+                                 '{}.'.format(negatives_path, bank.shape[1:],
+                                              self.patch_size))
+            return bank
+        negs = sorted(glob(os.path.normpath(negatives_path) + '/*png'))
+        key = hashlib.sha1(repr((negs, tuple(self.patch_size))).encode())
+        bankpath = bankdir + 'negatives_' + key.hexdigest()
+        if ba.bank.PatchBank.exists(bankpath):
+            return ba.bank.PatchBank(bankpath)
+        return ba.bank.build_negative_bank(bankpath, negs, self.patch_size,
+                                           per_image=0)
 
     def gen_negs(self, n):
-        negs = glob(self.negatives_path + '/*png')
-        negs = random.sample(negs, n * self.ppI)
-        for it, neg in zip(range(1, len(negs) + 1), negs):
-            im = self.imread(neg)
-            im /= 255
-            im = tf.resize(im, (self.patch_size[0], self.patch_size[1], 3),
-                           mode='reflect')
-            self.samples[-it, ...] = im.transpose((2, 0, 1))
-
-    def gen_flow(self, batch_size=None):
-        from keras.preprocessing.image import ImageDataGenerator
-        if batch_size is None:
-            batch_size = self.batch_size
-        self.flow = ImageDataGenerator(
-            rotation_range=15,
-            shear_range=0.2,
-            zoom_range=0.2,
-            width_shift_range=0.05,
-            height_shift_range=0.05,
-            horizontal_flip=True,
-            data_format='channels_first',
-            preprocessing_function=self.preprocess_image
-            ).flow(self.samples, self.labels, batch_size=batch_size)
-
-    def reset_threads(self):
-        self.thread_count = 10
-        self.x_res = [None] * self.thread_count
-        self.y_res = [None] * self.thread_count
-        self.threads = [None] * self.thread_count
-        self.focus = 0
-        for n in range(self.thread_count):
-            self._rethread(n)
+        '''Draws the negatives of this run from the negative bank.'''
+        self.neg_idx = np.sort(random.sample(range(len(self.negatives)),
+                                             n * self.ppI))
+
+    def gather(self, idx, out=None):
+        '''Assembles the positive and negative samples at idx as float32 in
+        [0, 1].'''
+        if out is None:
+            out = np.empty((len(idx), 3) + tuple(self.patch_size),
+                           dtype=np.float32)
+        pos = idx < self.npos
+        out[pos] = self.samples.gather(idx[pos])
+        out[~pos] = self.negatives.gather(
+            self.neg_idx[idx[~pos] - self.npos])
+        return out
+
+    def start_workers(self):
+        '''Starts the processes producing the augmented batches.'''
+        shapes = [(self.batch_size, 3) + tuple(self.patch_size),
+                  (self.batch_size, )]
+        self.pool = ba.workers.SharedBatchPool(
+            self._produce, shapes, [np.float32, np.float32],
+            workers=self.workers, depth=self.depth, seed=self.seed)
+
+    def _draw(self, rng):
+        '''Draws the sample indices for one batch, epoch by epoch.'''
+        idx = []
+        while len(idx) < self.batch_size:
+            if self._pos >= len(self._order):
+                self._order = rng.permutation(len(self.labels))
+                self._pos = 0
+            take = self._order[self._pos:self._pos + self.batch_size -
+                               len(idx)]
+            self._pos += len(take)
+            idx.extend(take)
+        return np.array(idx)
+
+    def _produce(self, arrays, rng):
+        '''Fills one batch slot, runs inside the worker processes. The uint8
+        samples are only converted to float here.'''
+        x, y = arrays
+        idx = self._draw(rng)
+        self.augmenter(self.gather(idx), rng, out=x)
+        self.preprocess_batch(x, rng)
+        y[...] = self.labels[idx].reshape(y.shape)
+        return len(idx)
 
     def imread(self, path):
-        im = scipy.misc.imread(path)
-        if im.ndim == 2:
-            w, h = im.shape
-            _im = np.empty((w, h, 3), dtype=np.float32)
-            _im[:, :, 0] = im
-            _im[:, :, 1] = im
-            _im[:, :, 2] = im
-            im = _im
-        else:
-            im = np.array(im, dtype=np.float32)
-        im = im[:, :, ::-1]
-        return im
-
-    def sample_image(self, im, bb, shiftfactor=0.25):
-        bbshape = bounding_box_shape(bb)
-        padded_im = np.pad(im, ((bbshape[0], bbshape[0]),
-                                (bbshape[1], bbshape[1]), (0, 0),),
-                           mode='reflect')
-
-        rands = (2 * np.random.random((2, self.ppI)) - 1) * shiftfactor + 1
-        xsamples = (bbshape[0] * rands[0]).astype(np.int)
-        ysamples = (bbshape[1] * rands[1]).astype(np.int)
-
-        samples = np.zeros((self.ppI, 3,
-                            self.patch_size[0], self.patch_size[1]))
-        for it, xsample, ysample in zip(count(), xsamples, ysamples):
-            _x = [bb[0].start, bb[0].stop] + xsample
-            _y = [bb[1].start, bb[1].stop] + ysample
-            patch = np.copy(padded_im[_x[0]:_x[1], _y[0]:_y[1], :])
-            patch /= 255
-            sized_patch = tf.resize(patch, (self.patch_size[0],
-                                            self.patch_size[1], 3),
-                                    mode='reflect')
-            # sized_patch *= 255
-            samples[it, ...] = sized_patch.transpose((2, 0, 1))
-        return samples
+        return ba.bank.imread_bgr(path)
+
+    def sample_image(self, im, bblist, shiftfactor=0.25):
+        '''Samples ppI randomly shifted patches for every bounding box. All
+        crops of the image are resampled in one batched crop and resize,
+        crops reaching over the border are mirrored into the image.
+
+        Args:
+            im (ndarray): The image (h, w, 3) in the range [0, 255]
+            bblist (list): The bounding boxes as tuples of slices
+            shiftfactor (float, optional): The maximal shift relative to the
+                size of the box
+
+        Returns:
+            The patches (len(bblist), ppI, 3, h, w) in the range [0, 1]
+        '''
+        bbs = np.array([[bb[0].start, bb[1].start, bb[0].stop, bb[1].stop]
+                        for bb in bblist], dtype=np.float64)
+        bbshapes = bbs[:, None, 2:] - bbs[:, None, :2]
+        rands = (2 * np.random.random((len(bbs), self.ppI, 2)) - 1) * \
+            shiftfactor + 1
+        shifts = np.floor(bbshapes * rands) - bbshapes
+        boxes = bbs[:, None, :] + np.tile(shifts, 2)
+        samples = ba.augment.crop_and_resize(
+            im, boxes.reshape(-1, 4), self.patch_size)
+        samples /= 255
+        return samples.reshape((len(bbs), self.ppI, 3) +
+                               tuple(self.patch_size))
 
     def load_slice_dict(self, slicefile):
         slicedict = load(slicefile)
@@ -484,37 +597,30 @@ class SamplesGenerator(object):
         n_slices = sum([len(sl) for sl in cut_slice_dict.values()])
         return cut_slice_dict, n_slices
 
-    def _rethread(self, n):
-        self.threads[n] = Thread(target=self._next, args=(n, ))
-        self.threads[n].start()
-
-    def _next(self, n):
-        x, y = next(self.flow)
-        self.x_res[n] = x
-        self.y_res[n] = y
-
-    def preprocess_image(self, im):
-        hsv_im = skimage.color.rgb2hsv(im.transpose(1, 2, 0))
-        power_s = random.uniform(0.25, 4)
-        power_v = random.uniform(0.25, 4)
-        factor_s = random.uniform(0.7, 1.4)
-        factor_v = random.uniform(0.7, 1.4)
-        value_s = random.uniform(-0.1, 0.1)
-        value_v = random.uniform(-0.1, 0.1)
-        hsv_im[:, :, 1] = np.power(hsv_im[:, :, 1], power_s)
-        hsv_im[:, :, 1] = hsv_im[:, :, 1] * factor_s + value_s
-        hsv_im[:, :, 2] = np.power(hsv_im[:, :, 2], power_v)
-        hsv_im[:, :, 2] = hsv_im[:, :, 2] * factor_v + value_v
-        im = skimage.color.hsv2rgb(hsv_im).transpose(2, 0, 1)
-        im *= 255
-        im -= self.mean
-        return im
-
-    def next(self):
-        if self.threads[self.focus].isAlive():
-            self.threads[self.focus].join()
-        x = self.x_res[self.focus]
-        y = self.y_res[self.focus]
-        self._rethread(self.focus)
-        self.focus = (self.focus + 1) % self.thread_count
-        return x, y
+    def preprocess_batch(self, x, rng=np.random):
+        '''Jitters the colours of a batch in [0, 1] and subtracts the mean,
+        in place.'''
+        ba.augment.hsv_jitter(x, rng)
+        x *= 255
+        x -= self.mean
+        return x
+
+    def next(self, out=None):
+        '''Returns the next batch of exactly batch_size samples.
+
+        Args:
+            out (tuple, optional): The arrays (samples, labels) to fill, e.g.
+                the data of the top blobs. The batch is copied straight from
+                the shared slot into them.
+
+        Returns:
+            The samples and the labels
+        '''
+        (x, y), _ = self.pool.claim()
+        if out is None:
+            out = (np.array(x), np.array(y))
+        else:
+            out[0][...] = x
+            out[1][...] = y.reshape(out[1].shape)
+        self.pool.release()
+        return out
@@ -0,0 +1,134 @@
+import ctypes
+from itertools import count
+import multiprocessing as mp
+import numpy as np
+import os
+import random
+import time
+import traceback
+
+_ctx = mp.get_context('fork')
+
+
+class SharedBatchPool(object):
+    '''Produces batches in long lived worker processes. Every batch is
+    written into one slot of a ring of shared memory buffers, so batches
+    never get pickled. Slot s is always filled by worker s % workers and
+    slots are handed out in ring order, which makes the sequence of batches
+    deterministic for a given seed.'''
+
+    def __init__(self, produce, shapes, dtypes, workers=2, depth=4,
+                 seed=None, numbered=False):
+        '''Constructs a new SharedBatchPool and starts its workers.
+
+        Args:
+            produce (callable): Called in the workers as
+                produce(arrays, rng) with one array view per shape and a
+                np.random.RandomState. Fills the arrays and may return
+                some picklable metadata for the batch.
+            shapes (list of tuple): The shapes of the slot arrays
+            dtypes (list): The dtypes of the slot arrays
+            workers (int, optional): The count of worker processes
+            depth (int, optional): The count of slots in the ring, rounded up
+                to a multiple of workers
+            seed (int, optional): The base seed, worker w uses seed + w
+            numbered (bool, optional): Call produce(arrays, rng, batch) with
+                the running number of the batch instead
+        '''
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtypes = [np.dtype(d) for d in dtypes]
+        self.nworkers = max(1, workers)
+        self.depth = -(-max(depth, self.nworkers) // self.nworkers)
+        self.depth *= self.nworkers
+        if seed is None:
+            seed = random.randrange(2**31 - self.nworkers)
+        self.seed = seed
+        self.numbered = numbered
+        self.slots = [[_ctx.RawArray(ctypes.c_char, int(
+            np.prod(shape)) * dtype.itemsize)
+            for shape, dtype in zip(self.shapes, self.dtypes)]
+            for _ in range(self.depth)]
+        self.free = [_ctx.Semaphore(1) for _ in range(self.depth)]
+        self.queues = [_ctx.Queue() for _ in range(self.nworkers)]
+        self.focus = 0
+        self.claimed = None
+        self.wait_time = 0.0
+        self.processes = []
+        self._owner = os.getpid()
+        for w in range(self.nworkers):
+            p = _ctx.Process(target=self._work, args=(produce, w),
+                             daemon=True)
+            p.start()
+            self.processes.append(p)
+
+    def views(self, slot):
+        '''Returns the numpy views on the buffers of a slot.'''
+        return [np.frombuffer(buf, dtype=dtype).reshape(shape)
+                for buf, shape, dtype in zip(self.slots[slot], self.shapes,
+                                             self.dtypes)]
+
+    def _work(self, produce, w):
+        seed = self.seed + w
+        rng = np.random.RandomState(seed)
+        # Third party code in produce may use the global generators
+        random.seed(seed)
+        np.random.seed(seed)
+        for cycle in count():
+            for slot in range(w, self.depth, self.nworkers):
+                self.free[slot].acquire()
+                try:
+                    if self.numbered:
+                        meta = produce(self.views(slot), rng,
+                                       cycle * self.depth + slot)
+                    else:
+                        meta = produce(self.views(slot), rng)
+                except Exception:
+                    self.queues[w].put((slot, False, traceback.format_exc()))
+                    return
+                self.queues[w].put((slot, True, meta))
+
+    def claim(self):
+        '''Waits for the next batch in ring order.
+
+        Returns:
+            The list of array views of the slot and the metadata of the batch
+        '''
+        if self.claimed is not None:
+            self.release()
+        slot = self.focus
+        st = time.time()
+        _slot, ok, meta = self.queues[slot % self.nworkers].get()
+        self.wait_time += time.time() - st
+        if not ok:
+            raise RuntimeError('Batch worker failed:\n' + meta)
+        self.claimed = slot
+        self.focus = (self.focus + 1) % self.depth
+        return self.views(slot), meta
+
+    def release(self):
+        '''Hands the claimed slot back to its worker.'''
+        if self.claimed is not None:
+            self.free[self.claimed].release()
+            self.claimed = None
+
+    def next(self):
+        '''Returns copies of the arrays of the next batch and its metadata.'''
+        arrays, meta = self.claim()
+        arrays = [np.array(a) for a in arrays]
+        self.release()
+        return arrays, meta
+
+    def close(self):
+        '''Stops the workers.'''
+        if os.getpid() != self._owner:
+            return
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        self.processes = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
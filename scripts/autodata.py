@@ -1,28 +1,26 @@
 #!/usr/bin/env python3
+import argparse
 import json
-from ba.data import Generator
-import multiprocessing as mp
+from ba.data import MultiQueryGenerator
 
 TMPEXP = './data/tmp/experiments/'
 PPTMP = 'data/tmp/pascpart/'
-PSIZE = 8
 
 
-def run(fpath):
+def run(fpath, processes):
     with open(fpath) as f:
         parts = json.load(f)
 
-    with mp.Pool(PSIZE) as p:
-        p.map(runSingle, parts)
-
-
-def runSingle(d):
-    parts = ' '.join(d['shortparts'])
-    classes = ' '.join(d['classes'])
-    argv = ['--classes', classes, '--parts', parts, '--default']
-    gen = Generator(argv)
+    queries = [(d['classes'], d['shortparts']) for d in parts]
+    gen = MultiQueryGenerator(queries, ['--default', '--processes',
+                                        str(processes)])
     gen.run()
 
 
 if __name__ == '__main__':
-    run('./data/parts.json')
+    parser = argparse.ArgumentParser(
+        description='Generates the data of all parts.json entries')
+    parser.add_argument('--parts', type=str, default='./data/parts.json')
+    parser.add_argument('--processes', type=int, default=8)
+    args = parser.parse_args()
+    run(args.parts, args.processes)
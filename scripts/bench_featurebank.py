@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import argparse
+import ba.featurebank
+import numpy as np
+import time
+
+
+def run(args):
+    bank = ba.featurebank.FeatureBank(args.bank)
+    if args.weights is not None:
+        # Weights and bias of the fc_conv head, positive minus negative class
+        head = np.load(args.weights)
+        w = head['w'][1].ravel() - head['w'][0].ravel()
+        b = float(head['b'][1] - head['b'][0])
+    else:
+        w = np.random.RandomState(0).randn(bank.channels).astype(np.float32)
+        b = 0
+
+    st = time.time()
+    exact = bank.exact_scores(w, b)
+    print('uncompressed: {} cells, {:.1f} MB, {:.2f}s scan'.format(
+        bank.ncells, bank.ncells * bank.channels * 4 / 2**20,
+        time.time() - st))
+
+    configs = [('sq8', {})] + [('pq', {'m': m}) for m in args.m]
+    for kind, kwargs in configs:
+        quantizer = ba.featurebank.QUANTIZERS[kind](**kwargs)
+        bank.compress(quantizer, nsamples=args.nsamples, seed=0)
+        st = time.time()
+        bank.quantizer.scores(bank.codes, w, b)
+        scan = time.time() - st
+        for rerank in args.rerank:
+            recall = ba.featurebank.recall_at(bank, w, b, topk=args.topk,
+                                              rerank=rerank, exact=exact)
+            print('{}{}: {:.0f}x smaller, {:.2f}s scan, recall@{} with {} '
+                  're-ranked: {:.3f}'.format(
+                      kind, kwargs.get('m', ''),
+                      ba.featurebank.compression_ratio(bank), scan,
+                      args.topk, rerank, recall))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Recall versus compression of a FeatureBank')
+    parser.add_argument('bank', type=str, help='The bank directory')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='npz with the head weights w and biases b')
+    parser.add_argument('--topk', type=int, default=100)
+    parser.add_argument('--rerank', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--m', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--nsamples', type=int, default=100000)
+    run(parser.parse_args())
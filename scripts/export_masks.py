@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+from ba.maskarchive import MaskArchive
+import os
+
+
+def main(args):
+    for path in args.archives:
+        directory = args.out
+        if directory is None:
+            # The directory the png files used to live in
+            directory = os.path.splitext(path)[0]
+        with MaskArchive(path) as archive:
+            count = archive.export(directory, keys=args.ids)
+        print('Exported {} masks of {} to {}'.format(count, path, directory))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Writes the masks of mask archives as png files')
+    parser.add_argument('archives', type=str, nargs='+',
+                        help='The *.archive files of segmentations or patches')
+    parser.add_argument('--out', type=str, default=None,
+                        help='The output directory, defaults to the archive '
+                        'path without extension')
+    parser.add_argument('--ids', type=str, nargs='+', default=None,
+                        help='Only export these image ids')
+    main(parser.parse_args())
@@ -1,31 +1,35 @@
 #!/usr/bin/env python3
+import argparse
+import ba.bank
 from glob import glob
 import os.path
-from scipy.misc import imread
-import random
-from scipy.misc import imresize
-from scipy.misc import imsave
-from tqdm import tqdm
 
 
-PS = (224, 224)
-Folder = '/home/morris/var/hci-storage01/arthistoric_images/imageFiles_8'
+def main(args):
+    images = []
+    for folder in args.folders:
+        images += sorted(glob('{}/*.{}'.format(os.path.normpath(folder),
+                                               args.ext)))
+    bank = ba.bank.build_negative_bank(
+        args.bank, images, shape=tuple(args.size), per_image=args.per_image,
+        scale=tuple(args.scale), processes=args.processes, seed=args.seed)
+    print('Wrote {} patches of {} from {} images to {}.npy'.format(
+        len(bank), bank.shape, len(images), args.bank))
 
-d = os.path.normpath(Folder) + '/'
-td = os.path.normpath(Folder) + '_patches/'
-for imf in tqdm(glob(d + '*png')):
-    im = imread(imf)
-    bn = os.path.basename(imf)
-    for _ in range(9):
-        h, w = im.shape[:2]
-        _h = int(h * random.uniform(.01, .5))
-        _w = int(w * random.uniform(.01, .5))
-        _y = random.randint(0, h - _h - 1)
-        _x = random.randint(0, w - _w - 1)
-        if im.ndim == 3:
-            patch = im[_y:_y + _h, _x:_x + _w, :]
-            patch = imresize(patch, (224, 224, 3))
-        else:
-            patch = im[_y:_y + _h, _x:_x + _w]
-            patch = imresize(patch, (224, 224))
-        imsave('{}{}_{}.png'.format(td, bn, _), patch)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Samples random patches into a negative patch bank')
+    parser.add_argument('bank', type=str,
+                        help='The path of the bank without extension')
+    parser.add_argument('folders', type=str, nargs='+',
+                        help='The directories of the image corpus')
+    parser.add_argument('--ext', type=str, default='png')
+    parser.add_argument('--per_image', type=int, default=9)
+    parser.add_argument('--size', type=int, nargs=2, default=[224, 224])
+    parser.add_argument('--scale', type=float, nargs=2, default=[.01, .5],
+                        help='The range of the patch size relative to the '
+                             'image size')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
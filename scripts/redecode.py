@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+import ba.eval
+
+
+def main(args):
+    params = dict(thresh=args.thresh, nms_thresh=args.nms_thresh,
+                  scales=tuple(args.scales), ratios=tuple(args.ratios))
+    for archive in args.archives:
+        ba.eval.redecode(archive, slicefile=args.slicefile,
+                         processes=args.processes, **params)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Decodes persisted score maps again without inference')
+    parser.add_argument('archives', type=str, nargs='+',
+                        help='The *.scoremaps archives of test runs')
+    parser.add_argument('--slicefile', type=str, default=None,
+                        help='The seg.yaml to evaluate against')
+    parser.add_argument('--thresh', type=float, default=0.2)
+    parser.add_argument('--nms_thresh', type=float, default=0.5)
+    parser.add_argument('--scales', type=float, nargs='+',
+                        default=[1, 1.5, 2])
+    parser.add_argument('--ratios', type=float, nargs='+',
+                        default=[1, 4 / 3, 1.6180, 2, 2.76])
+    parser.add_argument('--processes', type=int, default=None)
+    main(parser.parse_args())